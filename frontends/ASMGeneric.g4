@@ -0,0 +1,56 @@
+grammar ASMGeneric;
+
+// Variant of ASM.g4 that lexes mnemonics as words. Instructions are classified by the keyword table of the
+// AST generator, so the parser only has to tell labels, instructions and directives apart.
+
+asmfile: (function | directive)+ EOF;
+function: function_header line+;
+function_header: function_header1 | function_header2;
+function_header1: 'thumb_func_start' name=WORD WORD ':';
+function_header2: align	'.globl' name=WORD '.type' WORD COMMA WORD '.thumb_func' WORD ':';
+
+line: (instruction | directive | label);
+label: name=WORD ':';
+instruction: mnemonic=WORD operand (COMMA operand)*;
+
+operand: reg writeback='!'?                    # registerOperand
+       | imm                                   # immediateOperand
+       | '[' rn=reg (COMMA rm=regimm)? ']'     # memoryOperand
+       | reglist                               # reglistOperand
+       | target=WORD ('+' offset=NUM)?         # symbolOperand
+       ;
+
+directive: align | data | include | syntax | dir_code | dir_gcc | dir_size | dir_file | dir_loc;
+align: '.align' NUM COMMA NUM;
+
+dir_code: '.code' NUM;
+dir_gcc: '.gcc2_compiled.:' WORD;
+dir_size: '.size' WORD COMMA WORD;
+dir_file: '.file' file_id=NUM file_path=STRING;
+dir_loc: '.loc' file_id=NUM file_line=NUM file_column=NUM;
+
+data: size=(DATA1 | DATA2 | DATA4) (const=WORD ('+' offset=NUM)? | value=NUM);
+
+include: '.include' STRING;
+
+syntax: '.syntax' ('divided' | 'unified');
+
+reglist: '{' reg (COMMA reg)* '}';
+regimm: reg | imm;
+reg: REG;
+imm: '#' NUM;
+
+STRING: '"' .*? '"';
+
+DATA1: '.1byte' | '.byte';
+DATA2: '.2byte' | '.half';
+DATA4: '.4byte' | '.word';
+
+COMMA: ',';
+REG: ('r' [0-9]) | 'lr' | 'pc' | 'sl' | 'sb' | 'ip' | 'sp';
+// hexadecimal numbers need the prefix, otherwise mnemonics like add or bcc would be numbers
+NUM: '-'? ('0x' [0-9a-fA-F]+ | [0-9]+);
+COMMENT: ('@' .*? NL) -> skip;
+WORD: [A-Za-z0-9._-]+;
+WS: (' ' | '\t') -> skip;
+NL: ('\r' | '\r'?'\n') -> skip;
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+from cache import parser_version
+from parser import normalize, split_functions, renumber_labels
+
+MAGIC = b'PYCCIDX1'
+HEADER = struct.Struct('<8s64sI')
+ENTRY = struct.Struct('<32sQI')
+
+
+def function_key(name: str, text: str) -> bytes:
+    # whitespace at the end of lines and empty lines do not change the parsed function
+    lines = [line.rstrip() for line in text.splitlines()]
+    content = '\n'.join([line for line in lines if line])
+    return hashlib.sha256(f'{name}\0{content}'.encode()).digest()
+
+
+def normalize_function(text: str) -> Optional[str]:
+    try:
+        return normalize(text, debug=False)
+    except ValueError:
+        return None
+
+
+def index_file(path: str, previous: Optional[str] = None) -> Tuple[List[Tuple[bytes, str]], int]:
+    entries = []
+    failed = 0
+    # entries only depend on the text of their function, unchanged functions keep their output
+    index = AsmIndex.open(previous) if previous else None
+    with open(path, 'r', errors='replace') as f:
+        for name, text in split_functions(f):
+            if name is None:
+                continue
+            key = function_key(name, text)
+            output = index.lookup(key) if index is not None else None
+            if output is None:
+                try:
+                    output = normalize_function(text)
+                except Exception:
+                    output = None
+            if output is None:
+                failed += 1
+                continue
+            entries.append((key, output))
+    return entries, failed
+
+
+def find_sources(directory: str) -> List[str]:
+    sources = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith('.s') or file.endswith('.inc'):
+                sources.append(os.path.join(root, file))
+    return sources
+
+
+def write_index(filename: str, entries: Iterable[Tuple[bytes, str]]):
+    table = {}
+    for key, output in entries:
+        table[key] = output.encode()
+    keys = sorted(table)
+    offset = HEADER.size + len(keys) * ENTRY.size
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, parser_version().encode(), len(keys)))
+        for key in keys:
+            f.write(ENTRY.pack(key, offset, len(table[key])))
+            offset += len(table[key])
+        for key in keys:
+            f.write(table[key])
+    # replace atomically, running processes keep their mapping of the old index
+    os.replace(tmp, filename)
+
+
+def build_index(directory: str, filename: str, jobs: Optional[int] = None, previous: Optional[str] = None) \
+        -> Tuple[int, int]:
+    entries = []
+    failed = 0
+    sources = find_sources(directory)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for file_entries, file_failed in executor.map(index_file, sources, [previous] * len(sources), chunksize=8):
+            entries += file_entries
+            failed += file_failed
+    write_index(filename, entries)
+    return len(entries), failed
+
+
+class AsmIndex:
+    data: mmap.mmap
+    count: int
+
+    def __init__(self, data: mmap.mmap, count: int):
+        self.data = data
+        self.count = count
+
+    @staticmethod
+    def open(filename: str) -> Optional['AsmIndex']:
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(data) < HEADER.size:
+            return None
+        magic, version, count = HEADER.unpack_from(data)
+        # an index built by another version of the frontend might contain different output
+        if magic != MAGIC or version != parser_version().encode():
+            return None
+        return AsmIndex(data, count)
+
+    def get(self, name: str, text: str) -> Optional[str]:
+        return self.lookup(function_key(name, text))
+
+    def lookup(self, key: bytes) -> Optional[str]:
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = HEADER.size + middle * ENTRY.size
+            if self.data[position:position + 32] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+        entry_key, offset, length = ENTRY.unpack_from(self.data, HEADER.size + low * ENTRY.size)
+        if entry_key != key:
+            return None
+        return self.data[offset:offset + length].decode()
+
+    def normalize(self, lines: Iterable[str]) -> Optional[str]:
+        """
+        Returns the processed assembly if every function is known, None otherwise.
+        """
+        outputs = []
+        for name, text in split_functions(lines):
+            if name is None:
+                continue
+            output = self.get(name, text)
+            if output is None:
+                return None
+            outputs.append(renumber_labels(output, len(outputs)))
+        if not outputs:
+            return None
+        return ''.join(outputs)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build an index of processed functions for pycc')
+    parser.add_argument('directory', help='assembly source directory')
+    parser.add_argument('index', help='index file')
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes', required=False)
+    parser.add_argument('--incremental', action='store_true',
+                        help='reuse the entries of the existing index, only new or changed functions are processed',
+                        required=False)
+    args = parser.parse_args(argv)
+    count, failed = build_index(args.directory, args.index, args.jobs, args.index if args.incremental else None)
+    print(f'indexed {count} functions, {failed} functions could not be processed')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,78 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import Optional
+
+FRONTEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@lru_cache(maxsize=None)
+def parser_version() -> str:
+    # any change to the frontend sources or the grammar may change the output
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(FRONTEND_DIR)):
+        if name.endswith('.py') or name.endswith('.g4'):
+            with open(os.path.join(FRONTEND_DIR, name), 'rb') as f:
+                h.update(name.encode())
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def _mtime(entry: os.DirEntry) -> int:
+    try:
+        return entry.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+class OutputCache:
+    directory: str
+    max_entries: int
+
+    def __init__(self, directory: str, max_entries: int = 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts: str) -> str:
+        h = hashlib.sha256(parser_version().encode())
+        for part in parts:
+            h.update(b'\0')
+            h.update(part.encode())
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.s')
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        # the modification time is used as last access time for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return text
+
+    def put(self, key: str, text: str):
+        path = self.path(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.s')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
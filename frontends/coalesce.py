@@ -0,0 +1,157 @@
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+from cache import parser_version
+from stats import CounterStore
+
+POLL_INTERVAL = 0.02
+# results are only reused by requests that waited for them, older ones are removed
+RESULT_LIFETIME = 3600
+# the directory is scanned for old results and locks at most this often
+PRUNE_INTERVAL = 60
+
+
+class Singleflight:
+    """
+    Coalesces identical requests of concurrent pycc processes.
+    The first request holds a lock while it runs, duplicates wait for the lock and reuse its output and diagnostics.
+    """
+    directory: str
+    timeout: float
+    counters: CounterStore
+
+    def __init__(self, directory: str, timeout: float):
+        self.directory = directory
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+        self.counters = CounterStore(os.path.join(directory, 'counters.json'))
+
+    def key(self, *parts: str) -> str:
+        h = hashlib.sha256(parser_version().encode())
+        for part in parts:
+            h.update(b'\0')
+            h.update(part.encode(errors='surrogateescape'))
+        return h.hexdigest()
+
+    def acquire(self, lock, deadline: float) -> bool:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(POLL_INTERVAL)
+
+    def load(self, path: str, since: float) -> Optional[dict]:
+        try:
+            if os.stat(path).st_mtime < since:
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store(self, path: str, destination: str, status: int, errors: str):
+        output = None
+        if os.path.exists(destination):
+            with open(destination, 'r', errors='surrogateescape') as f:
+                output = f.read()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', errors='surrogateescape') as f:
+            json.dump({'status': status, 'output': output, 'errors': errors}, f)
+        os.replace(tmp, path)
+
+    def prune(self):
+        now = time.time()
+        marker = os.path.join(self.directory, 'pruned')
+        try:
+            if os.stat(marker).st_mtime > now - PRUNE_INTERVAL:
+                return
+        except FileNotFoundError:
+            pass
+        with open(marker, 'a'):
+            os.utime(marker)
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime >= now - RESULT_LIFETIME:
+                    continue
+                if entry.name.endswith('.json') and entry.name != 'counters.json':
+                    os.remove(entry.path)
+                elif entry.name.endswith('.lock'):
+                    self.remove_lock(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def remove_lock(self, path: str):
+        # requests touch their lock when they open it, so an old lock is only removed if nobody holds it
+        with open(path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            os.remove(path)
+
+    def run(self, key: str, destination: str, work: Callable[[], int]) -> int:
+        path = os.path.join(self.directory, key)
+        since = time.time()
+        while True:
+            with open(path + '.lock', 'a') as lock:
+                os.utime(lock.fileno())
+                leader = self.acquire(lock, time.monotonic())
+                if not leader and not self.acquire(lock, time.monotonic() + self.timeout):
+                    self.counters.increment('timeout')
+                    return work()
+                if not current(lock, path + '.lock'):
+                    # the lock was pruned after it was opened, the other requests lock the new one
+                    continue
+                if not leader:
+                    result = self.load(path + '.json', since)
+                    if result is not None:
+                        self.counters.increment('coalesced')
+                        if result['output'] is not None:
+                            with open(destination, 'w', errors='surrogateescape') as f:
+                                f.write(result['output'])
+                        sys.stderr.write(result['errors'])
+                        return result['status']
+                self.counters.increment('leader')
+                status, errors = capture_stderr(work)
+                self.store(path + '.json', destination, status, errors)
+                self.prune()
+                return status
+
+
+def current(lock, path: str) -> bool:
+    """
+    Whether an open lock file is still the one at path.
+    """
+    try:
+        return os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+def capture_stderr(work: Callable[[], int]) -> (int, str):
+    """
+    Runs work with file descriptor 2 redirected, so the output of child processes is captured as well.
+    The captured text is also written to the original stderr.
+    """
+    sys.stderr.flush()
+    saved = os.dup(2)
+    with tempfile.TemporaryFile('w+', errors='surrogateescape') as capture:
+        os.dup2(capture.fileno(), 2)
+        try:
+            status = work()
+        finally:
+            sys.stderr.flush()
+            os.dup2(saved, 2)
+            os.close(saved)
+        capture.seek(0)
+        errors = capture.read()
+    sys.stderr.write(errors)
+    return status, errors
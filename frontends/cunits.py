@@ -0,0 +1,105 @@
+import re
+from typing import Iterator, List, NamedTuple, Optional
+
+TOKEN = re.compile(r'''
+     (?P<directive>^[ \t]*\#(?:\\\n|[^\n])*)
+    |(?P<space>\s+)
+    |(?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<string>"(?:\\.|[^"\\\n])*")
+    |(?P<char>'(?:\\.|[^'\\\n])*')
+    |(?P<ident>[A-Za-z_]\w*)
+    |(?P<number>\.?\d(?:[eEpP][+-]|[\w.])*)
+    |(?P<punct>\.\.\.|->|<<=|>>=|[-+*/%&|^!=<>]=|&&|\|\||\+\+|--|<<|>>|\#\#|.)
+''', re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+
+class Token(NamedTuple):
+    kind: str
+    text: str
+    start: int
+    end: int
+
+
+def tokenize(text: str) -> Iterator[Token]:
+    for match in TOKEN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space' or kind == 'comment':
+            continue
+        yield Token(kind, match.group(), match.start(), match.end())
+
+
+class Item:
+    """
+    A top level construct of a C file: a function definition, a declaration or a preprocessor directive.
+    Items are contiguous, the text of all items is the text of the file.
+    """
+    kind: str
+    start: int
+    end: int
+    tokens: List[Token]
+    name: Optional[str]
+
+    def __init__(self, kind: str, start: int, end: int, tokens: List[Token]):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.tokens = tokens
+        self.name = function_name(tokens) if kind == 'function' else None
+
+    def text(self, source: str) -> str:
+        return source[self.start:self.end]
+
+
+def function_name(tokens: List[Token]) -> Optional[str]:
+    # the name is in front of the parameter list, which is the last parenthesis before the body
+    body = next(i for i, token in enumerate(tokens) if token.text == '{')
+    depth = 0
+    for i in range(body - 1, -1, -1):
+        if tokens[i].text == ')':
+            depth += 1
+        elif tokens[i].text == '(':
+            depth -= 1
+            if depth == 0:
+                if i > 0 and tokens[i - 1].kind == 'ident':
+                    return tokens[i - 1].text
+                return None
+    return None
+
+
+def split_items(text: str) -> List[Item]:
+    items = []
+    start = 0
+    tokens = []
+    braces = 0
+    parens = 0
+    function = False
+    for token in tokenize(text):
+        if token.kind == 'directive' and not tokens:
+            items.append(Item('directive', start, token.end, [token]))
+            start = token.end
+            continue
+        tokens.append(token)
+        if token.text in '([':
+            parens += 1
+        elif token.text in ')]':
+            parens -= 1
+        elif token.text == '{':
+            if braces == 0 and parens == 0 and len(tokens) > 1 and tokens[-2].text == ')':
+                function = True
+            braces += 1
+        elif token.text == '}':
+            braces -= 1
+            if braces == 0 and function:
+                items.append(Item('function', start, token.end, tokens))
+                start = token.end
+                tokens = []
+                function = False
+        elif token.text == ';' and braces == 0 and parens == 0:
+            items.append(Item('declaration', start, token.end, tokens))
+            start = token.end
+            tokens = []
+    if tokens:
+        items.append(Item('declaration', start, len(text), tokens))
+    elif items:
+        items[-1].end = len(text)
+    return items
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from asm_index import find_sources as find_asm_sources
+from cunits import split_items
+from parser import normalize, split_functions
+from prewarm import compiler_options, find_sources as find_c_sources
+
+PYCC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pycc.py')
+
+
+class Result(NamedTuple):
+    name: str
+    status: str
+    detail: str = ''
+
+
+def normalize_function(text: str) -> Optional[str]:
+    try:
+        return normalize(text, debug=False)
+    except Exception:
+        return None
+
+
+def function_hash(output: str) -> bytes:
+    return hashlib.sha256(output.encode()).digest()
+
+
+def reference_functions(path: str) -> Iterator[Tuple[str, str]]:
+    with open(path, 'r', errors='replace') as f:
+        if path.endswith('.inc'):
+            # NONMATCH and ASM_FUNC bodies only contain the instructions, named after the file
+            name = os.path.splitext(os.path.basename(path))[0]
+            yield name, f'\tthumb_func_start {name}\n{name}:\n' + f.read()
+            return
+        for name, text in split_functions(f):
+            if name is not None:
+                yield name, text
+
+
+def normalize_reference(path: str, names: Optional[Set[str]]) -> Dict[str, Optional[str]]:
+    return {name: normalize_function(text) for name, text in reference_functions(path)
+            if names is None or name in names}
+
+
+def compile_source(options: List[str], path: str, names: Optional[Set[str]]) -> Dict[str, Optional[str]]:
+    with open(path, 'r', errors='surrogateescape') as f:
+        text = f.read()
+    with tempfile.TemporaryDirectory(prefix='matchcheck') as directory:
+        source = os.path.join(directory, os.path.basename(path))
+        output = os.path.join(directory, 'output.s')
+        with open(source, 'w', errors='surrogateescape') as f:
+            f.write(text)
+        # NONMATCHING compiles the C of functions whose assembly is still included from the asm tree
+        subprocess.run([sys.executable, PYCC] + options + ['--no-parse', '--define', 'NONMATCHING',
+                                                           '-o', output, '-S', source],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not os.path.exists(output):
+            return {}
+        with open(output, 'r', errors='replace') as f:
+            return {name: normalize_function(text) for name, text in split_functions(f)
+                    if name is not None and (names is None or name in names)}
+
+
+def first_difference(expected: str, actual: str) -> str:
+    expected_lines = expected.splitlines()
+    actual_lines = actual.splitlines()
+    for i in range(max(len(expected_lines), len(actual_lines))):
+        want = expected_lines[i].strip() if i < len(expected_lines) else '<end>'
+        got = actual_lines[i].strip() if i < len(actual_lines) else '<end>'
+        if want != got:
+            return f'line {i + 1}: expected `{want}` got `{got}`'
+    return ''
+
+
+def compile_with(options: List[str], path: str, flag: Optional[str]) -> Optional[str]:
+    """
+    Compiles a copy of a C source with pycc, with a flag or without it.
+    """
+    with open(path, 'r', errors='surrogateescape') as f:
+        text = f.read()
+    with tempfile.TemporaryDirectory(prefix='flagcheck') as directory:
+        source = os.path.join(directory, os.path.basename(path))
+        output = os.path.join(directory, 'output.s')
+        with open(source, 'w', errors='surrogateescape') as f:
+            f.write(text)
+        subprocess.run([sys.executable, PYCC] + options + ([flag] if flag else []) + ['-g', '-o', output, '-S', source],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not os.path.exists(output):
+            return None
+        with open(output, 'r', errors='replace') as f:
+            # the temporary directory is part of the debug information
+            return f.read().replace(directory, '<directory>')
+
+
+def check_flag(options: List[str], path: str, flag: str,
+               canonical: Callable[[str], str] = lambda text: text) -> Tuple[str, str]:
+    expected = compile_with(options, path, None)
+    actual = compile_with(options, path, flag)
+    if expected is None or actual is None:
+        return 'error', 'no output'
+    expected = canonical(expected)
+    actual = canonical(actual)
+    if expected != actual:
+        return 'mismatch', first_difference(expected, actual)
+    return 'match', ''
+
+
+def check_flag_sources(directory: str, options: List[str], flag: str, jobs: Optional[int],
+                       canonical: Callable[[str], str] = lambda text: text):
+    """
+    Compiles every C source of a directory with and without a pycc flag, reports the sources whose assembly differs
+    and exits with 1 if there are any.
+    """
+    sources = find_c_sources(directory)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda path: check_flag(options, path, flag, canonical), sources))
+    for path, (status, detail) in zip(sources, results):
+        print(f'{status:<9}{os.path.relpath(path, directory)}' + (f'  {detail}' if detail else ''))
+    matched = len([status for status, _ in results if status == 'match'])
+    print(f'{matched}/{len(results)} sources produce the same assembly', file=sys.stderr)
+    sys.exit(0 if matched == len(results) else 1)
+
+
+def compare(name: str, reference: Optional[str], compiled: Optional[str]) -> Result:
+    if reference is None:
+        return Result(name, 'error', 'reference assembly could not be normalized')
+    if compiled is None:
+        return Result(name, 'error', 'compiled assembly could not be normalized')
+    if function_hash(reference) == function_hash(compiled):
+        return Result(name, 'match')
+    return Result(name, 'mismatch', first_difference(reference, compiled))
+
+
+def check(repo: str, options: List[str], names: Optional[Set[str]], jobs: Optional[int]) -> List[Result]:
+    references = {}
+    compiled = {}
+    c_sources = []
+    for path in find_c_sources(os.path.join(repo, 'src')):
+        with open(path, 'r', errors='surrogateescape') as f:
+            defined = {item.name for item in split_items(f.read()) if item.kind == 'function'}
+        if names is None or defined & names:
+            c_sources.append(path)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        reference_futures = [executor.submit(normalize_reference, path, names)
+                             for path in find_asm_sources(os.path.join(repo, 'asm'))]
+        compile_futures = [executor.submit(compile_source, options, path, names) for path in c_sources]
+        for future in reference_futures:
+            references.update(future.result())
+        for future in compile_futures:
+            compiled.update(future.result())
+
+    results = []
+    for name in sorted(names if names is not None else references.keys() & compiled.keys()):
+        if name not in references:
+            results.append(Result(name, 'missing', 'no reference assembly'))
+        elif name not in compiled:
+            results.append(Result(name, 'missing', 'not in the compiled C'))
+        else:
+            results.append(compare(name, references[name], compiled[name]))
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Check whether decompiled functions match the reference assembly')
+    parser.add_argument('repo', help='tmc repository')
+    parser.add_argument('--function', action='append', dest='names',
+                        help='function to check, all functions with reference assembly and C by default',
+                        required=False)
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes', required=False)
+    args, options = parser.parse_known_args(argv)
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+
+    results = check(args.repo, options, set(args.names) if args.names else None, args.jobs)
+    for result in results:
+        print(f'{result.status:<9}{result.name}' + (f'  {result.detail}' if result.detail else ''))
+    matched = len([result for result in results if result.status == 'match'])
+    print(f'{matched}/{len(results)} functions match', file=sys.stderr)
+    sys.exit(0 if matched == len(results) else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
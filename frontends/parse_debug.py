@@ -1,3 +1,5 @@
+from io import StringIO
+
 # Line number opcodes.
 # https://github.com/gittup/binutils/blob/8db2e9c8d085222ac7b57272ee263733ae193565/elfcpp/dwarf.h#L179
 DW_LNS_extended_op = 0
@@ -221,33 +223,44 @@ def parse_debug_line_section(f):
     return debug_lines
 
 
-def process_debug_info(path: str) -> None:
+def insert_debug_info(text: str) -> str:
+    """
+    Adds .loc directives for the line numbers of the debug line section and removes the sections.
+    """
     code = []
     debug_lines = []
-    with open(path, 'r') as f:
+    f = StringIO(text)
+    line = f.readline()
+    while '.section' not in line and len(line) > 0:
+        code.append(line)
         line = f.readline()
-        while '.section' not in line and len(line) > 0:
-            code.append(line)
-            line = f.readline()
 
-        while len(line) > 0:
-            if '.section' in line and '.debug_line' in line:
-                debug_lines = parse_debug_line_section(f)
-            line = f.readline()
+    while len(line) > 0:
+        if '.section' in line and '.debug_line' in line:
+            debug_lines = parse_debug_line_section(f)
+        line = f.readline()
 
     line_dict = {}
     for (label, line) in debug_lines:
         line_dict[label] = line
 
     wrote_file_path = False
+    output = StringIO()
+    # Insert debug info
+    for line in code:
+        if line.startswith('.') and ':' in line:  # Line is a label
+            label_name = line.strip()[:-1]
+            if label_name in line_dict:
+                if not wrote_file_path:
+                    output.write('.file 1 "example.c"\n')
+                    wrote_file_path = True
+                output.write(f'.loc 1 {line_dict[label_name]} 1\n')
+        output.write(line)
+    return output.getvalue()
+
+
+def process_debug_info(path: str) -> None:
+    with open(path, 'r') as f:
+        text = f.read()
     with open(path, 'w') as f:
-        # Insert debug info
-        for line in code:
-            if line.startswith('.') and ':' in line:  # Line is a label
-                label_name = line.strip()[:-1]
-                if label_name in line_dict:
-                    if not wrote_file_path:
-                        f.write('.file 1 "example.c"\n')
-                        wrote_file_path = True
-                    f.write(f'.loc 1 {line_dict[label_name]} 1\n')
-            f.write(line)
+        f.write(insert_debug_info(text))
@@ -1,19 +1,222 @@
+import mmap
+import re
+import threading
+import time
 from enum import Enum
-from typing import List, Optional, TextIO, Union
+from fnmatch import fnmatchcase
+from io import StringIO
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, TextIO, Tuple, Union
 from weakref import ref
 
 import antlr4
+from antlr4.error.ErrorListener import ConsoleErrorListener
+from antlr4.error.ErrorStrategy import BailErrorStrategy, DefaultErrorStrategy
+from antlr4.error.Errors import ParseCancellationException
 
+from antlr.ASMGenericLexer import ASMGenericLexer
+from antlr.ASMGenericParser import ASMGenericParser
 from antlr.ASMLexer import ASMLexer
 from antlr.ASMParser import ASMParser
 from antlr.ASMVisitor import ASMVisitor
+from parse_debug import insert_debug_info
 
 
-def parse(filename: str) -> (ASMParser.AsmfileContext, bool):
-    lexer = ASMLexer(antlr4.FileStream(filename))
-    parser = ASMParser(antlr4.CommonTokenStream(lexer))
+class ParseStage(Enum):
+    SLL = 0
+    LL = 1
+
+
+class Grammar(Enum):
+    # one token and parser rule per mnemonic
+    ASM = 0
+    # mnemonics are words, classified by the keyword table of GenericASTGenerator
+    GENERIC = 1
+
+
+RECOGNIZERS = {
+    Grammar.ASM: (ASMLexer, ASMParser),
+    Grammar.GENERIC: (ASMGenericLexer, ASMGenericParser),
+}
+
+
+class DFACache(threading.local):
+    """
+    The generated recognizers share their DFA cache in class attributes, which the runtime updates without locking.
+    Every thread gets its own cache instead.
+    """
+
+    def __init__(self):
+        self.dfas = {}
+        self.contexts = {}
+
+    def get(self, recognizer) -> List[antlr4.DFA]:
+        if recognizer not in self.dfas:
+            self.dfas[recognizer] = [antlr4.DFA(state, i) for i, state in enumerate(recognizer.atn.decisionToState)]
+            self.contexts[recognizer] = antlr4.PredictionContextCache()
+        return self.dfas[recognizer]
+
+
+dfa_cache = DFACache()
+
+
+class ByteStream(antlr4.InputStream):
+    """
+    Lexer input over the bytes of ASCII text, e.g. an mmap of the file. InputStream keeps a list with an int object per
+    character, indexing bytes returns the character code without allocating anything.
+    """
+
+    def __init__(self, data: Union[bytes, mmap.mmap], name: str = '<bytes>'):
+        self.name = name
+        self.strdata = None
+        self.data = data
+        self._index = 0
+        self._size = len(data)
+
+    def LA(self, offset: int) -> int:
+        # the lexer almost only looks at the next character
+        if offset == 1:
+            try:
+                return self.data[self._index]
+            except IndexError:
+                return antlr4.Token.EOF
+        if offset == 0:
+            return 0
+        pos = self._index + offset - 1 if offset > 0 else self._index + offset
+        if pos < 0 or pos >= self._size:
+            return antlr4.Token.EOF
+        return self.data[pos]
+
+    def LT(self, offset: int) -> int:
+        return self.LA(offset)
+
+    def getText(self, start: int, stop: int) -> str:
+        if start >= self._size:
+            return ''
+        return self.data[start:min(stop, self._size - 1) + 1].decode('ascii')
+
+    def __str__(self):
+        return self.data[:].decode('ascii')
+
+
+NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+
+def open_stream(filename: str) -> antlr4.InputStream:
+    """
+    Maps ASCII files into memory. Anything else is read by FileStream as before.
+    """
+    with open(filename, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return antlr4.InputStream('')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if NON_ASCII.search(data):
+        data.close()
+        return antlr4.FileStream(filename)
+    return ByteStream(data, filename)
+
+
+def text_stream(text: str) -> antlr4.InputStream:
+    return ByteStream(text.encode('ascii')) if text.isascii() else antlr4.InputStream(text)
+
+
+def create_lexer(stream: antlr4.InputStream, grammar: Grammar = Grammar.ASM) -> antlr4.Lexer:
+    lexer_class = RECOGNIZERS[grammar][0]
+    lexer = lexer_class(stream)
+    lexer._interp = antlr4.LexerATNSimulator(lexer, lexer.atn, dfa_cache.get(lexer_class),
+                                             antlr4.PredictionContextCache())
+    return lexer
+
+
+def create_parser(tokens: antlr4.CommonTokenStream, grammar: Grammar = Grammar.ASM) -> antlr4.Parser:
+    parser_class = RECOGNIZERS[grammar][1]
+    parser = parser_class(tokens)
+    parser._interp = antlr4.ParserATNSimulator(parser, parser.atn, dfa_cache.get(parser_class),
+                                               dfa_cache.contexts[parser_class])
+    return parser
+
+
+def parse(filename: str, fail_fast: bool = True, grammar: Grammar = Grammar.ASM) -> (ASMParser.AsmfileContext,
+                                                                                      Optional[ParseStage]):
+    return parse_stream(open_stream(filename), fail_fast, grammar)
+
+
+def parse_string(text: str, fail_fast: bool = True, grammar: Grammar = Grammar.ASM) -> (ASMParser.AsmfileContext,
+                                                                                         Optional[ParseStage]):
+    return parse_stream(text_stream(text), fail_fast, grammar)
+
+
+def parse_stream(stream: antlr4.InputStream, fail_fast: bool = True, grammar: Grammar = Grammar.ASM) -> \
+        (ASMParser.AsmfileContext, Optional[ParseStage]):
+    tokens = antlr4.CommonTokenStream(create_lexer(stream, grammar))
+    parser = create_parser(tokens, grammar)
+
+    # stage 1: SLL prediction, give up on the first syntax error
+    parser._interp.predictionMode = antlr4.PredictionMode.SLL
+    parser._errHandler = BailErrorStrategy()
+    parser.removeErrorListeners()
+    try:
+        return parser.asmfile(), ParseStage.SLL
+    except ParseCancellationException:
+        pass
+
+    # stage 2: full LL prediction, only fails on actual syntax errors
+    tokens.seek(0)
+    parser.reset()
+    parser._interp.predictionMode = antlr4.PredictionMode.LL
+    if fail_fast:
+        try:
+            return parser.asmfile(), ParseStage.LL
+        except ParseCancellationException:
+            return None, None
+    parser._errHandler = DefaultErrorStrategy()
+    parser.addErrorListener(ConsoleErrorListener.INSTANCE)
     tree = parser.asmfile()
-    return tree, parser.getNumberOfSyntaxErrors() == 0
+    if parser.getNumberOfSyntaxErrors() != 0:
+        return tree, None
+    return tree, ParseStage.LL
+
+
+FUNCTION_HEADER1 = re.compile(r'\s*thumb_func_start\s+([A-Za-z0-9._-]+)')
+FUNCTION_HEADER2 = re.compile(r'\s*\.globl\s+([A-Za-z0-9._-]+)')
+ALIGN = re.compile(r'\s*\.align\b')
+
+
+def split_functions(lines: Iterable[str]) -> Iterator[Tuple[Optional[str], str]]:
+    """
+    Textual pre-scan for the function headers of the grammar.
+    Yields (name, text) for every function and (None, text) for everything in front of the first function.
+    """
+    name = None
+    chunk = []
+    for line in lines:
+        match = FUNCTION_HEADER1.match(line)
+        start = len(chunk)
+        if not match:
+            match = FUNCTION_HEADER2.match(line)
+            # function_header2 starts with the alignment
+            if match and chunk and ALIGN.match(chunk[-1]):
+                start -= 1
+        if match:
+            yield name, ''.join(chunk[:start])
+            name = match.group(1)
+            chunk = chunk[start:]
+        chunk.append(line)
+    yield name, ''.join(chunk)
+
+
+def select_functions(lines: Iterable[str], patterns: List[str]) -> Tuple[str, List[str]]:
+    """
+    Keeps everything in front of the first function and the functions whose name matches one of the glob patterns.
+    Returns the text and the names of the selected functions.
+    """
+    selected = []
+    names = []
+    for name, text in split_functions(lines):
+        if name is None or any([fnmatchcase(name, pattern) for pattern in patterns]):
+            selected.append(text)
+            if name is not None:
+                names.append(name)
+    return ''.join(selected), names
 
 
 def suffix(suffix: str, condition: bool) -> str:
@@ -527,15 +730,23 @@ class LocDirective(Directive):
         self.column = column
 
 
+class Analysis(Enum):
+    LABELS = 0
+    LINKS = 1
+    LABEL_TYPES = 2
+
+
 class Function(ASTNode):
     name: str
     instructions: List[Instruction]
     labels: List[LABEL]
+    analyses: Set[Analysis]
 
     def __init__(self, name: str, instructions: List[Instruction]):
         self.name = name
         self.instructions = instructions
         self.labels = []
+        self.analyses = set()
 
 
 class ASMFile(ASTNode):
@@ -809,25 +1020,205 @@ class ASTGenerator(ASMVisitor):
         return LocDirective(file, line, column)
 
 
+class Memory(NamedTuple):
+    rn: Register
+    rm: Optional[Operand]
+
+
+class Symbol(NamedTuple):
+    target: str
+    offset: Optional[int]
+
+
+class Writeback(NamedTuple):
+    rn: Register
+
+
+def operand_kinds(operands: list) -> str:
+    kinds = {Register: 'r', Constant: 'i', Memory: 'm', Symbol: 's', Writeback: 'w', list: 'l'}
+    return ''.join([kinds[type(operand)] for operand in operands])
+
+
+def expect(mnemonic: str, operands: list, *shapes: str) -> str:
+    kinds = operand_kinds(operands)
+    if kinds not in shapes:
+        raise ValueError(f'invalid operands for {mnemonic}')
+    return kinds
+
+
+def build_operation(cls):
+    def build(mnemonic: str, operands: list) -> Instruction:
+        if len(expect(mnemonic, operands, 'rr', 'ri', 'rrr', 'rri')) == 2:
+            return cls(operands[0], operands[0], operands[1])
+        return cls(*operands)
+
+    return build
+
+
+def build_branch(cls):
+    def build(mnemonic: str, operands: list) -> Instruction:
+        expect(mnemonic, operands, 's')
+        if operands[0].offset is not None:
+            raise ValueError(f'invalid operands for {mnemonic}')
+        return cls(operands[0].target)
+
+    return build
+
+
+def build_ldr(size: int, signed: bool):
+    def build(mnemonic: str, operands: list) -> Instruction:
+        expect(mnemonic, operands, 'rm')
+        return LDR(operands[0], operands[1].rn, operands[1].rm, size, signed)
+
+    return build
+
+
+def build_str(size: int):
+    def build(mnemonic: str, operands: list) -> Instruction:
+        expect(mnemonic, operands, 'rm')
+        return STR(operands[0], operands[1].rn, operands[1].rm, size)
+
+    return build
+
+
+def build_ldr_word(mnemonic: str, operands: list) -> Instruction:
+    if expect(mnemonic, operands, 'rs', 'rm') == 'rm':
+        return LDR(operands[0], operands[1].rn, operands[1].rm, 4, False)
+    rt, symbol = operands
+    if symbol.offset is not None:
+        return LDR_PC(rt, symbol.target, symbol.offset)
+    return LDR_PC(rt, symbol.target)
+
+
+def build_mul(mnemonic: str, operands: list) -> Instruction:
+    if expect(mnemonic, operands, 'rr', 'rrr') == 'rr':
+        return MUL(operands[0], operands[1], operands[0])
+    return MUL(*operands)
+
+
+def build_rsb(mnemonic: str, operands: list) -> Instruction:
+    expect(mnemonic, operands, 'rri')
+    if not operands[2].value == 0:
+        raise ValueError('rsb only allowed with 0 immediate')
+    return NEG(operands[0], operands[1])
+
+
+def build_with_shapes(cls, *shapes: str):
+    def build(mnemonic: str, operands: list) -> Instruction:
+        expect(mnemonic, operands, *shapes)
+        return cls(*operands)
+
+    return build
+
+
+def build_stm(mnemonic: str, operands: list) -> Instruction:
+    expect(mnemonic, operands, 'wl')
+    return STM(operands[0].rn, operands[1])
+
+
+# keyword table of the generic grammar, accepts the same instructions as ASM.g4
+MNEMONICS: Dict[str, Callable[[str, list], Instruction]] = {
+    'push': build_with_shapes(PUSH, 'l'),
+    'pop': build_with_shapes(POP, 'l'),
+    'mul': build_mul,
+    'muls': build_mul,
+    'rsb': build_rsb,
+    'rsbs': build_rsb,
+    'neg': build_with_shapes(NEG, 'rr'),
+    'mov': build_with_shapes(MOV, 'rr', 'ri'),
+    'movs': build_with_shapes(MOV, 'rr', 'ri'),
+    'cmp': build_with_shapes(CMP, 'rr', 'ri'),
+    'cmn': build_with_shapes(CMN, 'rr', 'ri'),
+    'bx': build_with_shapes(BX, 'r'),
+    'ldr': build_ldr_word,
+    'ldrh': build_ldr(2, False),
+    'ldrsh': build_ldr(2, True),
+    'ldrb': build_ldr(1, False),
+    'ldrsb': build_ldr(1, True),
+    'str': build_str(4),
+    'strh': build_str(2),
+    'strb': build_str(1),
+    'stm': build_stm,
+    'stmia': build_stm,
+}
+for operation_class in [ADD, SUB, AND, ORR, EOR, LSL, LSR, ASL, ASR, BIC]:
+    MNEMONICS[operation_class.mnemonic] = build_operation(operation_class)
+    MNEMONICS[operation_class.mnemonic + 's'] = build_operation(operation_class)
+for branch_mnemonic, branch_class in [('b', B), ('bl', BL), ('beq', BEQ), ('bne', BNE), ('bcs', BHS), ('bhs', BHS),
+                                      ('bcc', BLO), ('blo', BLO), ('bmi', BMI), ('bpl', BPL), ('bvs', BVS),
+                                      ('bvc', BVC), ('bhi', BHI), ('bls', BLS), ('bge', BGE), ('blt', BLT),
+                                      ('bgt', BGT), ('ble', BLE)]:
+    MNEMONICS[branch_mnemonic] = build_branch(branch_class)
+
+
+class GenericASTGenerator(ASTGenerator):
+    """
+    Builds the same AST as ASTGenerator from a parse tree of ASMGeneric.g4.
+    The rules the grammars have in common are handled by ASTGenerator.
+    """
+
+    def visitInstruction(self, ctx: ASMGenericParser.InstructionContext):
+        mnemonic = ctx.mnemonic.text
+        build = MNEMONICS.get(mnemonic)
+        if build is None:
+            raise ValueError(f'unknown instruction {mnemonic}')
+        return build(mnemonic, [self.visit(operand) for operand in ctx.operand()])
+
+    def visitRegisterOperand(self, ctx: ASMGenericParser.RegisterOperandContext):
+        register = self.visit(ctx.reg())
+        if ctx.writeback:
+            return Writeback(register)
+        return register
+
+    def visitImmediateOperand(self, ctx: ASMGenericParser.ImmediateOperandContext):
+        return self.visit(ctx.imm())
+
+    def visitMemoryOperand(self, ctx: ASMGenericParser.MemoryOperandContext):
+        return Memory(self.visit(ctx.rn), self.visit(ctx.rm) if ctx.rm else None)
+
+    def visitReglistOperand(self, ctx: ASMGenericParser.ReglistOperandContext):
+        return self.visit(ctx.reglist())
+
+    def visitSymbolOperand(self, ctx: ASMGenericParser.SymbolOperandContext):
+        return Symbol(ctx.target.text, int(ctx.offset.text, 0) if ctx.offset else None)
+
+    def visitData(self, ctx: ASMGenericParser.DataContext):
+        size = {ASMGenericParser.DATA1: 1, ASMGenericParser.DATA2: 2, ASMGenericParser.DATA4: 4}[ctx.size.type]
+        if ctx.value:
+            return DATA(size, int(ctx.value.text, 0))
+        if ctx.offset:
+            if size != 4:
+                raise ValueError('offsets are only allowed for words')
+            return DATA(size, ctx.const.text, int(ctx.offset.text, 0))
+        return DATA(size, ctx.const.text)
+
+
+def link_function(function: Function):
+    labels = {}
+    for label in function.instructions:
+        if isinstance(label, LABEL):
+            labels[label.name] = label
+            label.loads = []
+    prev_insn: Optional[Instruction] = None
+    for instruction in function.instructions:
+        if prev_insn is not None:
+            instruction._prev = ref(prev_insn)
+            prev_insn._next = ref(instruction)
+        prev_insn = instruction
+        if isinstance(instruction, Branch):
+            label = labels.get(instruction.label)
+            if label is not None:
+                instruction._target = ref(label)
+        if isinstance(instruction, LDR_PC):
+            label = labels.get(instruction.label)
+            if label is not None:
+                instruction._target = ref(label)
+                label.loads.append(instruction)
+
+
 def link_instructions(asmfile: ASMFile):
     for function in asmfile.functions:
-        prev_insn: Optional[Instruction] = None
-        for instruction in function.instructions:
-            if prev_insn is not None:
-                instruction._prev = ref(prev_insn)
-                prev_insn._next = ref(instruction)
-            prev_insn = instruction
-            if isinstance(instruction, Branch):
-                for label in function.instructions:
-                    if isinstance(label, LABEL):
-                        if label.name == instruction.label:
-                            instruction._target = ref(label)
-            if isinstance(instruction, LDR_PC):
-                for label in function.instructions:
-                    if isinstance(label, LABEL):
-                        if label.name == instruction.label:
-                            instruction._target = ref(label)
-                            label.loads.append(instruction)
+        link_function(function)
 
 
 class ASTVisitor:
@@ -1019,19 +1410,26 @@ class ClassifyLabels(ASTVisitor):
 
 
 class RenameLabels(ASTVisitor):
-    ncode = 0
-    ndata = 0
-    ncase = 0
-    nother = 0
-    nfunction = 0
+    ncode: int
+    ndata: int
+    ncase: int
+    nother: int
+    nfunction: int
+
+    def __init__(self):
+        self.nfunction = 0
+        self.begin_function()
 
     def visit_function(self, function: Function):
+        self.begin_function()
+        super(RenameLabels, self).visit_function(function)
+        self.nfunction += 1
+
+    def begin_function(self):
         self.ncode = 0
         self.ndata = 0
         self.ncase = 0
         self.nother = 0
-        super(RenameLabels, self).visit_function(function)
-        self.nfunction += 1
 
     def visit_label(self, label: LABEL):
         if label.type == LabelType.CODE:
@@ -1048,27 +1446,18 @@ class RenameLabels(ASTVisitor):
             self.nother += 1
 
 
+RENAMED_LABEL = re.compile(r'\b_(code|case|data|other)0_(?=\d)')
+
+
+def renumber_labels(text: str, nfunction: int) -> str:
+    """
+    Changes the labels of a dumped function that was renamed as the first function to belong to function nfunction.
+    """
+    return RENAMED_LABEL.sub(lambda match: f'_{match.group(1)}{nfunction}_', text)
+
+
 def merge_data_labels(ast: ASMFile):
-    for function in ast.functions:
-        instruction = function.instructions[0]
-        current_data: Optional[LABEL] = None
-        ndata = 0
-        while instruction is not None:
-            if isinstance(instruction, LABEL):
-                if instruction.type == LabelType.DATA:
-                    if current_data:
-                        for load in instruction.loads:
-                            load._target = ref(current_data)
-                            load.offset += ndata * 4
-                        instruction.type = LabelType.OTHER
-                    else:
-                        current_data = instruction
-            elif isinstance(instruction, DATA):
-                ndata += 1
-            else:
-                current_data = None
-                ndata = 0
-            instruction = instruction.next
+    PassManager([MergeDataLabels()]).run(ast)
 
 
 class PatchInstructions(ASTVisitor):
@@ -1116,10 +1505,222 @@ class PatchInstructions(ASTVisitor):
         return loc
 
 
-def apply_transformations(ast: ASMFile):
-    PatchInstructions().visit(ast)
-    merge_data_labels(ast)
-    RenameLabels().visit(ast)
+def collect_labels(function: Function):
+    function.labels = []
+    CollectLabels().visit(function)
+
+
+def classify_labels(function: Function):
+    ClassifyLabels().visit(function)
+
+
+# analysis: (required analyses, function computing it)
+ANALYSES = {
+    Analysis.LABELS: (set(), collect_labels),
+    Analysis.LINKS: ({Analysis.LABELS}, link_function),
+    Analysis.LABEL_TYPES: ({Analysis.LABELS, Analysis.LINKS}, classify_labels),
+}
+
+
+def invalidated_by(analyses: Set[Analysis]) -> Set[Analysis]:
+    """
+    The analyses together with every analysis that is computed from one of them.
+    """
+    invalidated = set(analyses)
+    changed = True
+    while changed:
+        dependents = {analysis for analysis, (requires, _) in ANALYSES.items() if requires & invalidated}
+        changed = not dependents <= invalidated
+        invalidated |= dependents
+    return invalidated
+
+
+class FunctionPass:
+    name: str
+    requires: Set[Analysis] = set()
+    invalidates: Set[Analysis] = set()
+
+    def run(self, function: Function):
+        pass
+
+
+class InstructionPass(FunctionPass):
+    """
+    A pass that looks at every instruction once, in order.
+    step returns the replacement for the instruction, or None to remove it.
+    Consecutive instruction passes are fused into a single walk over the function.
+    """
+
+    def begin(self, function: Function):
+        pass
+
+    def step(self, instruction: Instruction) -> Optional[Instruction]:
+        return instruction
+
+    def end(self, function: Function):
+        pass
+
+    def run(self, function: Function):
+        walk_function(function, [self])
+
+
+def walk_function(function: Function, passes: List[InstructionPass]):
+    for p in passes:
+        p.begin(function)
+    news = []
+    prev: Optional[Instruction] = None
+    for instruction in function.instructions:
+        new: Optional[Instruction] = instruction
+        for p in passes:
+            new = p.step(new)
+            if new is None:
+                break
+        if new:
+            if prev:
+                prev._next = ref(new)
+                new._prev = ref(prev)
+            else:
+                new._prev = None
+            prev = new
+            news.append(new)
+    if prev:
+        prev._next = None
+    function.instructions = news
+    for p in passes:
+        p.end(function)
+
+
+class Patch(InstructionPass):
+    name = 'PatchInstructions'
+
+    def __init__(self):
+        self.patcher = PatchInstructions()
+
+    def step(self, instruction: Instruction) -> Optional[Instruction]:
+        return self.patcher.visit(instruction)
+
+
+class MergeDataLabels(InstructionPass):
+    name = 'merge_data_labels'
+    requires = {Analysis.LINKS, Analysis.LABEL_TYPES}
+    current_data: Optional[LABEL]
+    ndata: int
+
+    def begin(self, function: Function):
+        self.current_data = None
+        self.ndata = 0
+
+    def step(self, instruction: Instruction) -> Optional[Instruction]:
+        if isinstance(instruction, LABEL):
+            if instruction.type == LabelType.DATA:
+                if self.current_data:
+                    for load in instruction.loads:
+                        load._target = ref(self.current_data)
+                        load.offset += self.ndata * 4
+                    instruction.type = LabelType.OTHER
+                else:
+                    self.current_data = instruction
+        elif isinstance(instruction, DATA):
+            self.ndata += 1
+        else:
+            self.current_data = None
+            self.ndata = 0
+        return instruction
+
+
+class Rename(InstructionPass):
+    name = 'RenameLabels'
+    requires = {Analysis.LABEL_TYPES}
+    invalidates = {Analysis.LABELS}
+
+    def __init__(self):
+        self.renamer = RenameLabels()
+
+    def begin(self, function: Function):
+        self.renamer.begin_function()
+
+    def step(self, instruction: Instruction) -> Optional[Instruction]:
+        self.renamer.visit(instruction)
+        return instruction
+
+    def end(self, function: Function):
+        self.renamer.nfunction += 1
+
+
+def transformation_passes() -> List[FunctionPass]:
+    return [Patch(), MergeDataLabels(), Rename()]
+
+
+class PassManager:
+    """
+    Runs passes function by function, computing the analyses they require on demand.
+    Analyses stay valid until a pass invalidates them.
+    """
+    passes: List[FunctionPass]
+    disabled: Set[str]
+    fuse: bool
+    timings: Dict[str, float]
+
+    def __init__(self, passes: Optional[List[FunctionPass]] = None, disabled: Iterable[str] = (), fuse: bool = True):
+        self.passes = transformation_passes() if passes is None else passes
+        self.disabled = set(disabled)
+        self.fuse = fuse
+        self.timings = {}
+
+    def time(self, name: str, start: float):
+        self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def ensure(self, function: Function, analysis: Analysis):
+        if analysis in function.analyses:
+            return
+        requires, compute = ANALYSES[analysis]
+        for required in requires:
+            self.ensure(function, required)
+        start = time.perf_counter()
+        compute(function)
+        self.time(compute.__name__, start)
+        function.analyses.add(analysis)
+
+    def groups(self) -> List[List[FunctionPass]]:
+        groups = []
+        invalidated = set()
+        for p in self.passes:
+            if p.name in self.disabled:
+                continue
+            # a pass can only join the walk if the passes before it keep its analyses valid
+            if self.fuse and isinstance(p, InstructionPass) and groups and \
+                    isinstance(groups[-1][-1], InstructionPass) and not p.requires & invalidated:
+                groups[-1].append(p)
+                invalidated |= invalidated_by(p.invalidates)
+            else:
+                groups.append([p])
+                invalidated = invalidated_by(p.invalidates)
+        return groups
+
+    def prepare(self, ast: ASMFile):
+        for function in ast.functions:
+            for analysis in Analysis:
+                self.ensure(function, analysis)
+
+    def run(self, ast: ASMFile):
+        groups = self.groups()
+        for function in ast.functions:
+            for group in groups:
+                for p in group:
+                    for analysis in p.requires:
+                        self.ensure(function, analysis)
+                start = time.perf_counter()
+                if len(group) > 1:
+                    walk_function(function, group)
+                else:
+                    group[0].run(function)
+                self.time('+'.join([p.name for p in group]), start)
+                for p in group:
+                    function.analyses -= invalidated_by(p.invalidates)
+
+
+def apply_transformations(ast: ASMFile, manager: Optional[PassManager] = None):
+    (manager or PassManager()).run(ast)
 
 
 class ASTDump(ASTVisitor):
@@ -1139,9 +1740,110 @@ class ASTDump(ASTVisitor):
         self.file.write(f'\t{instruction}\n')
 
 
-def generate_ast(tree: ASMParser.AsmfileContext) -> ASMFile:
-    ast = ASTGenerator().visit(tree)
-    link_instructions(ast)
-    CollectLabels().visit(ast)
-    ClassifyLabels().visit(ast)
+# DATA is dumped as .{size}byte, unprocessed functions of the chunked mode keep the directives of agbcc
+DATA_DIRECTIVES = {'.1byte', '.byte', '.2byte', '.4byte', '.hword', '.short', '.word', '.long', '.ascii', '.asciz',
+                   '.space', '.fill', '.incbin'}
+SYMBOL = re.compile(r'(?<![\w.$])[A-Za-z_.$][\w.$]*')
+LINE_MAP_VERSION = 1
+
+
+def line_map(lines: Iterable[str]) -> dict:
+    """
+    Describes every line of the output of ASTDump for the compiler explorer frontend, so it does not need to parse it:
+    kinds has one character per line, e(mpty), l(abel), d(irective), D(ata) or i(nstruction).
+    source has the [file, line] of every instruction and data line, labels the line of every label definition
+    and references the [line, label] of every operand that is a label of the output.
+    """
+    kinds = []
+    source = []
+    files = {}
+    labels = {}
+    operands = []
+    location = None
+    for number, line in enumerate(lines):
+        text = line.strip()
+        first, rest = (text.split(None, 1) + ['', ''])[:2]
+        if not text:
+            kind = 'e'
+        elif text.endswith(':'):
+            kind = 'l'
+            labels[text[:-1]] = number
+        elif first == '.loc':
+            kind = 'd'
+            file, line_number = rest.split()[:2]
+            location = [int(file), int(line_number)]
+        elif first == '.file':
+            kind = 'd'
+            id, path = (rest.split(None, 1) + ['', ''])[:2]
+            files[id] = path.strip('"')
+        elif first in DATA_DIRECTIVES:
+            kind = 'D'
+            operands.append((number, rest))
+        elif first.startswith('.'):
+            kind = 'd'
+        else:
+            kind = 'i'
+            if first == 'thumb_func_start':
+                location = None
+            operands.append((number, rest))
+        kinds.append(kind)
+        source.append(location if kind in 'iD' else None)
+    references = [[number, name] for number, rest in operands for name in SYMBOL.findall(rest) if name in labels]
+    return {'version': LINE_MAP_VERSION, 'kinds': ''.join(kinds), 'source': source, 'files': files, 'labels': labels,
+            'references': references}
+
+
+def generate_ast(tree: ASMParser.AsmfileContext, manager: Optional[PassManager] = None) -> ASMFile:
+    generator = GenericASTGenerator() if isinstance(tree, ASMGenericParser.AsmfileContext) else ASTGenerator()
+    ast = generator.visit(tree)
+    (manager or PassManager()).prepare(ast)
     return ast
+
+
+def process_chunked(lines: Iterable[str], file: TextIO, manager: Optional[PassManager] = None,
+                    grammar: Grammar = Grammar.ASM) -> List[str]:
+    """
+    Parses, transforms and dumps one function at a time, so only a single function is kept in memory.
+    Functions that cannot be parsed or processed are written unprocessed, their names are returned.
+    """
+    manager = manager or PassManager()
+    failed = []
+    for name, text in split_functions(lines):
+        # everything in front of the first function is not part of the output
+        if name is None:
+            continue
+        # a function is only written once it is completely processed
+        output = StringIO()
+        try:
+            tree, stage = parse_string(text, fail_fast=True, grammar=grammar)
+            if stage is None:
+                raise ValueError('could not parse function')
+            ast = generate_ast(tree, manager)
+            # the rename pass keeps counting functions, so the labels are the same as for the whole file
+            manager.run(ast)
+            ASTDump(output).visit(ast)
+        except Exception:
+            failed.append(name)
+            file.write(text)
+            continue
+        file.write(output.getvalue())
+    return failed
+
+
+def normalize(text: str, *, debug: bool = True, grammar: Grammar = Grammar.ASM) -> str:
+    """
+    Processes agbcc assembly in memory, the library entry point of the frontend.
+    No state is shared between calls, so it can be called from several threads at once.
+    Raises ValueError if the assembly cannot be parsed.
+    """
+    if debug:
+        text = insert_debug_info(text)
+    tree, stage = parse_string(text, grammar=grammar)
+    if stage is None:
+        raise ValueError('could not parse assembly')
+    manager = PassManager()
+    ast = generate_ast(tree, manager)
+    apply_transformations(ast, manager)
+    output = StringIO()
+    ASTDump(output).visit(ast)
+    return output.getvalue()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from prewarm import compiler_options, find_sources
+
+INCLUDE = re.compile(r'[ \t]*#[ \t]*include[ \t]*(["<])([^">]+)[">][ \t]*(//.*)?$')
+BLANK = re.compile(r'[ \t]*(//.*)?$')
+STDIN_MARKER = re.compile(r'^(# \d+ )"<stdin>"', re.MULTILINE)
+LINE_MARKER = re.compile(r'# (\d+) "((?:\\.|[^"\\])*)"')
+SNAPSHOT_VERSION = 2
+# __BASE_FILE__ in the headers of a snapshot would expand to "", this makes it recognizable
+STDIN_BASE_FILE = ['-U__BASE_FILE__', '-D__BASE_FILE__="<stdin>"']
+# appended to the include block of a source to check the macros that name the source
+FILE_PROBE = 'const char *prefix_file = __FILE__, *prefix_base_file = __BASE_FILE__; int prefix_line = __LINE__;\n'
+
+
+def leading_includes(lines: List[str]) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    The number of lines of the include block at the start of a source and its includes as (quote, name).
+    The block ends with the last include before anything that is not an include, a blank line or a line comment.
+    """
+    count = 0
+    includes = []
+    for n, line in enumerate(lines):
+        if line.rstrip('\r\n').endswith('\\'):
+            break
+        match = INCLUDE.match(line.rstrip('\r\n'))
+        if match:
+            includes.append((match.group(1), match.group(2)))
+            count = n + 1
+        elif not BLANK.match(line.rstrip('\r\n')):
+            break
+    return count, includes
+
+
+def cpp(cpp_args: List[str], text: str, *extra: str) -> Optional[str]:
+    process = subprocess.run(cpp_args + list(extra) + ['-', '-o', '-'], input=text.encode(errors='surrogateescape'),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if process.returncode != 0:
+        return None
+    return process.stdout.decode(errors='surrogateescape')
+
+
+def dependencies(path: str) -> List[str]:
+    with open(path, 'r') as f:
+        rule = f.read().replace('\\\n', ' ')
+    return [os.path.abspath(dependency) for dependency in rule.partition(':')[2].split()]
+
+
+def stamps(paths: List[str]) -> Optional[List[List]]:
+    result = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        result.append([path, stat.st_size, stat.st_mtime_ns])
+    return result
+
+
+def snapshot_key(cpp_args: List[str], prefix: str) -> str:
+    # relative include paths depend on the working directory
+    return hashlib.sha256('\0'.join([str(SNAPSHOT_VERSION), os.getcwd(), *cpp_args, prefix]).encode(
+        errors='surrogateescape')).hexdigest()
+
+
+def load_snapshot(base: str) -> Optional[str]:
+    """
+    Returns the expanded prefix of a snapshot, with "<stdin>" as the name of the source. BASE.h has the macros defined
+    at the end of the prefix.
+    """
+    try:
+        with open(base + '.json', 'r') as f:
+            recorded = json.load(f)
+        with open(base + '.i', 'r', errors='surrogateescape') as f:
+            text = f.read()
+    except (FileNotFoundError, ValueError):
+        return None
+    # any change to one of the headers of the prefix invalidates it
+    if stamps([path for path, _, _ in recorded]) != recorded:
+        return None
+    return text
+
+
+def make_snapshot(cpp_args: List[str], prefix: str, base: str) -> Optional[str]:
+    unique = f'{os.getpid()}.{threading.get_ident()}'
+    deps = f'{base}.{unique}.d'
+    try:
+        text = cpp(cpp_args, prefix, '-MD', '-MF', deps, *STDIN_BASE_FILE)
+        if text is None:
+            return None
+        recorded = stamps(dependencies(deps))
+    finally:
+        if os.path.exists(deps):
+            os.remove(deps)
+    defined = cpp(cpp_args, prefix, '-dM', *STDIN_BASE_FILE)
+    predefined = cpp(cpp_args, '', '-dM', *STDIN_BASE_FILE)
+    if recorded is None or defined is None or predefined is None:
+        return None
+    # the predefined macros and the -D options are defined again for the rest anyway
+    builtin = set(predefined.splitlines())
+    macros = ''.join([line + '\n' for line in defined.splitlines() if line not in builtin])
+    for extension, content in [('.i', text), ('.h', macros), ('.json', json.dumps(recorded))]:
+        with open(f'{base}.{unique}.tmp', 'w', errors='surrogateescape') as f:
+            f.write(content)
+        # the stamps are written last, a snapshot is only used once they exist
+        os.replace(f'{base}.{unique}.tmp', base + extension)
+    return text
+
+
+def preprocess_prefix(cpp_args: List[str], source: str, output: str, cache_dir: str) -> Optional[str]:
+    """
+    Preprocesses a source with the snapshot of its leading include block, only the rest of the source is run through
+    cpp, with the macros of the snapshot. Returns 'hit' or 'miss' for the snapshot, None if the source has to be
+    preprocessed as a whole, nothing is written then.
+    """
+    with open(source, 'r', errors='surrogateescape') as f:
+        lines = f.readlines()
+    count, includes = leading_includes(lines)
+    if not includes:
+        return None
+    # quoted includes are searched next to the source first, which is different for every request
+    if any([quote == '"' and os.path.exists(os.path.join(os.path.dirname(source), name))
+            for quote, name in includes]):
+        return None
+    prefix = ''.join(lines[:count])
+    os.makedirs(cache_dir, exist_ok=True)
+    base = os.path.join(cache_dir, snapshot_key(cpp_args, prefix))
+    expanded = load_snapshot(base)
+    result = 'hit'
+    if expanded is None:
+        expanded = make_snapshot(cpp_args, prefix, base)
+        result = 'miss'
+    # __BASE_FILE__ in a header of the prefix names the snapshot, not the source
+    if expanded is None or '"<stdin>"' in STDIN_MARKER.sub('', expanded):
+        return None
+    name = source.replace('\\', '\\\\').replace('"', '\\"')
+    # blank lines keep the line numbers of the rest, the last one names the source for __FILE__
+    rest = cpp(cpp_args, '\n' * (count - 1) + f'#line {count + 1} "{name}"\n' + ''.join(lines[count:]),
+               '-imacros', base + '.h', '-U__BASE_FILE__', f'-D__BASE_FILE__="{name}"')
+    if rest is None:
+        # cpp reports the errors of the whole source
+        return None
+    # everything up to the -imacros file is the same as the start of the prefix
+    start = [match.start() for match in re.finditer(r'^# \d+ "<command-line>".*\n', rest, re.MULTILINE)]
+    if not start:
+        return None
+    rest = rest[rest.index('\n', start[-1]) + 1:]
+    with open(output, 'w', errors='surrogateescape') as f:
+        f.write(STDIN_MARKER.sub(lambda match: f'{match.group(1)}"{name}"', expanded + rest))
+    return result
+
+
+def logical_lines(text: str) -> List[Tuple[str, int, str]]:
+    """
+    The non-blank lines of preprocessed text with the file and line number the line markers give them.
+    """
+    lines = []
+    name = ''
+    number = 0
+    for line in text.splitlines():
+        match = LINE_MARKER.match(line)
+        if match:
+            name = match.group(2)
+            number = int(match.group(1))
+            continue
+        if line.strip():
+            lines.append((name, number, line))
+        number += 1
+    return lines
+
+
+def check_source(cpp_args: List[str], path: str, cache_dir: str) -> Tuple[str, str]:
+    with tempfile.TemporaryDirectory(prefix='prefix') as directory:
+        output = os.path.join(directory, 'output.i')
+        start = time.perf_counter()
+        subprocess.run(cpp_args + [path, '-o', output], stderr=subprocess.DEVNULL)
+        whole = time.perf_counter() - start
+        if not os.path.exists(output):
+            return 'error', 'cpp failed'
+        with open(output, 'r', errors='surrogateescape') as f:
+            expected = logical_lines(f.read())
+        os.remove(output)
+        start = time.perf_counter()
+        result = preprocess_prefix(cpp_args, path, output, cache_dir)
+        if result is None:
+            return 'skipped', 'no usable include block'
+        with open(output, 'r', errors='surrogateescape') as f:
+            actual = logical_lines(f.read())
+    timing = f'{result} {(time.perf_counter() - start) * 1000:.0f}ms, cpp {whole * 1000:.0f}ms'
+    if expected != actual:
+        for n, (a, b) in enumerate(zip(expected, actual)):
+            if a != b:
+                return 'mismatch', f'{timing}, line {n}: expected {a} got {b}'
+        return 'mismatch', f'{timing}, {len(expected)} lines expected, got {len(actual)}'
+    return 'match', timing
+
+
+def check_file_macros(cpp_args: List[str], sources: List[str], cache_dir: str) -> Tuple[str, str]:
+    """
+    Checks __FILE__, __BASE_FILE__ and __LINE__ after the include block of the first source that has a usable one.
+    """
+    with tempfile.TemporaryDirectory(prefix='probe') as directory:
+        for path in sources:
+            with open(path, 'r', errors='surrogateescape') as f:
+                lines = f.readlines()
+            count, includes = leading_includes(lines)
+            if not includes:
+                continue
+            probe = os.path.join(directory, os.path.basename(path))
+            with open(probe, 'w', errors='surrogateescape') as f:
+                f.write(''.join(lines[:count]) + FILE_PROBE)
+            status, detail = check_source(cpp_args, probe, cache_dir)
+            if status != 'skipped':
+                return status, f'{os.path.basename(path)} {detail}'
+    return 'skipped', 'no usable include block'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Preprocess every C source of a directory with cpp and with the '
+                                                 'snapshot of its leading include block and compare the lines')
+    parser.add_argument('directory', help='C source directory')
+    parser.add_argument('--prefix-cache', help='snapshot directory, a temporary directory by default',
+                        required=False)
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of sources preprocessed at the same time',
+                        required=False)
+    args, options = parser.parse_known_args(argv)
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+    # pycc imports this module
+    from pycc import parse_args, cpp_arguments
+    cpp_args = cpp_arguments(parse_args(options)[0])
+
+    sources = find_sources(args.directory)
+    with tempfile.TemporaryDirectory(prefix='snapshots') as directory:
+        cache_dir = args.prefix_cache or directory
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(lambda path: check_source(cpp_args, path, cache_dir), sources))
+        probe = check_file_macros(cpp_args, sources, cache_dir)
+    for path, (status, detail) in zip(sources, results):
+        print(f'{status:<9}{os.path.relpath(path, args.directory)}' + (f'  {detail}' if detail else ''))
+    print(f'{probe[0]:<9}__FILE__  {probe[1]}')
+    matched = len([status for status, _ in results if status in ('match', 'skipped')])
+    print(f'{matched}/{len(results)} sources preprocess to the same lines', file=sys.stderr)
+    sys.exit(0 if matched == len(results) and probe[0] != 'mismatch' else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
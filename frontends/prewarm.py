@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Tuple
+
+from cunits import split_items
+
+PYCC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pycc.py')
+
+
+def compiler_options(properties: str, compiler: str) -> List[str]:
+    with open(properties, 'r') as f:
+        for line in f:
+            key, _, value = line.strip().partition('=')
+            if key == f'compiler.{compiler}.options':
+                return shlex.split(value)
+    raise ValueError(f'no options for compiler {compiler} in {properties}')
+
+
+def find_sources(directory: str) -> List[str]:
+    sources = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith('.c'):
+                sources.append(os.path.join(root, file))
+    return sources
+
+
+def units(source: str, name: str, functions: bool) -> Iterator[Tuple[str, str]]:
+    with open(source, 'r', errors='surrogateescape') as f:
+        text = f.read()
+    yield name, text
+    if not functions:
+        return
+    # every function on its own, with everything that is not a function definition
+    items = split_items(text)
+    for function in items:
+        if function.kind != 'function':
+            continue
+        unit = ''.join([item.text(text) for item in items if item.kind != 'function' or item is function])
+        yield f'{name}:{function.name}', unit
+
+
+def request_arguments(options: List[str], output: str, source: str) -> List[str]:
+    # compiler explorer passes the options of its filters first, then the compiler options, the user options and the
+    # source. The compile cache key depends on the order of the cc1 flags.
+    return ['-g', '-o', output, '-S'] + options + [source]
+
+
+def compile_unit(options: List[str], text: str, nice: int) -> Tuple[int, str]:
+    with tempfile.TemporaryDirectory(prefix='prewarm') as directory:
+        source = os.path.join(directory, 'example.c')
+        with open(source, 'w', errors='surrogateescape') as f:
+            f.write(text)
+        # preexec_fn is not safe in threads
+        process = subprocess.run(['nice', '-n', str(nice), sys.executable, PYCC] +
+                                 request_arguments(options, os.path.join(directory, 'output.s'), source),
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return process.returncode, process.stderr.decode(errors='replace')
+
+
+def cache_hit(options: List[str], text: str) -> bool:
+    """
+    Compiles a prewarmed unit again as a new request, with --verbose, and checks that it is served from the cache.
+    """
+    status, errors = compile_unit(options + ['--verbose'], text, 0)
+    return status == 0 and '"result": "cache"' in errors
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compile all C sources of a repository to fill the pycc caches')
+    parser.add_argument('directory', help='C source directory')
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('--sources', help='file listing the sources to compile, one per line, instead of all sources '
+                                          'in the directory', required=False)
+    parser.add_argument('--functions', action='store_true', help='also compile every function on its own',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help='number of concurrent compilations', required=False)
+    parser.add_argument('--nice', type=int, default=19, help='niceness of the compilations', required=False)
+    parser.add_argument('--verify', action='store_true',
+                        help='check that a prewarmed source is a cache hit for a new request', required=False)
+    args, options = parser.parse_known_args(argv)
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+
+    if args.sources:
+        with open(args.sources, 'r') as f:
+            sources = [line.strip() for line in f if line.strip()]
+    else:
+        sources = find_sources(args.directory)
+    pending = []
+    for source in sources:
+        pending += units(source, os.path.relpath(source, args.directory), args.functions)
+
+    failed = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(compile_unit, options, text, args.nice): name for name, text in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            status = 'ok'
+            if future.result()[0] != 0:
+                failed += 1
+                status = 'failed'
+            print(f'[{done}/{len(pending)}] {futures[future]} {status}', file=sys.stderr)
+    print(f'compiled {len(pending)} units in {time.monotonic() - start:.1f}s, {failed} failed', file=sys.stderr)
+    if args.verify and pending:
+        name, text = pending[0]
+        hit = cache_hit(options, text)
+        print(f'{name} {"is" if hit else "is NOT"} a cache hit for a new request', file=sys.stderr)
+        if not hit:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import pstats
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+# call paths contributing less than this many seconds are not split up further
+MIN_WEIGHT = 1e-6
+MAX_DEPTH = 64
+
+Function = Tuple[str, int, str]
+
+
+def load_profiles(directory: str) -> pstats.Stats:
+    files = [os.path.join(directory, file) for file in sorted(os.listdir(directory)) if file.endswith('.pstats')]
+    if not files:
+        raise ValueError(f'no profiles in {directory}')
+    return pstats.Stats(*files)
+
+
+def label(function: Function) -> str:
+    filename, line, name = function
+    if filename == '~':
+        return name
+    return f'{os.path.basename(filename)}:{name}'
+
+
+def collapsed_stacks(stats: pstats.Stats) -> Dict[str, float]:
+    """
+    cProfile only records caller/callee edges, so the own time of every function is split up over its call paths
+    in proportion to the time spent in each caller.
+    """
+    entries = stats.stats
+    stacks = defaultdict(float)
+
+    def walk(function: Function, path: List[Function], weight: float):
+        # for recursion the time is attributed to the outermost call
+        callers = {caller: edge for caller, edge in entries[function][4].items() if caller not in path}
+        total = sum([edge[3] for edge in callers.values()])
+        if total <= 0 or weight < MIN_WEIGHT or len(path) > MAX_DEPTH:
+            stacks[';'.join([label(f) for f in reversed(path)])] += weight
+            return
+        for caller, edge in callers.items():
+            walk(caller, path + [caller], weight * edge[3] / total)
+
+    for function, (cc, nc, tt, ct, callers) in entries.items():
+        if tt > 0:
+            walk(function, [function], tt)
+    return stacks
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Merge sampled pycc profiles')
+    parser.add_argument('directory', help='profile spool directory')
+    parser.add_argument('--sort', default='tottime', help='sort key of the report', required=False)
+    parser.add_argument('--limit', type=int, default=40, help='number of functions in the report', required=False)
+    parser.add_argument('--collapsed', help='write collapsed stacks for flamegraph.pl to this file', required=False)
+    parser.add_argument('--clear', action='store_true', help='remove the merged profiles', required=False)
+    args = parser.parse_args(argv)
+
+    stats = load_profiles(args.directory)
+    if args.collapsed:
+        with open(args.collapsed, 'w') as f:
+            for stack, seconds in sorted(collapsed_stacks(stats).items()):
+                f.write(f'{stack} {round(seconds * 1e6)}\n')
+    else:
+        stats.sort_stats(args.sort).print_stats(args.limit)
+    if args.clear:
+        for file in stats.files:
+            os.remove(file)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
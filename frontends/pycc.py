@@ -1,18 +1,44 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
+import json
 import os
+import random
+import re
+import shlex
 import subprocess
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from shutil import copyfile
 
-from parser import parse, generate_ast, apply_transformations, ASTDump
+from asm_index import AsmIndex
+from cache import OutputCache
+from coalesce import Singleflight
+from stats import HistogramStore, StageTimer, print_histograms
+from parser import parse, generate_ast, apply_transformations, ASTDump, PassManager, process_chunked, Grammar, \
+    line_map, select_functions
 from parse_debug import process_debug_info
+from prefix import preprocess_prefix
+from split import compile_split
+from treeshake import shake_file
+
+timer = StageTimer()
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+    return number
+
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='Simplified CC1 frontend')
     parser.add_argument('--qinclude', action='append', help='Include Paths for iquote', required=False)
     parser.add_argument('--binclude', action='append', help='Include Paths for Block Include', required=False)
+    parser.add_argument('--define', action='append', help='Macro definitions for the preprocessor', required=False)
     parser.add_argument('--cc1', help='<Required> cc1 Path', required=False)
     parser.add_argument('--version', help='Get Version String of cc1', required=False)
     parser.add_argument('--preproc', help='preproc path', required=False)
@@ -21,10 +47,62 @@ def parse_args(argv):
     parser.add_argument('-o', help='Output Assembly file', required=False, dest='destination')
     parser.add_argument('--no-parse', action='store_true', help='disable parsing of agbcc output (debug option)',
                         required=False)
+    parser.add_argument('--sidecar', action='store_true',
+                        help='describe the lines of the processed assembly in OUTPUT.json for the compiler explorer '
+                             'frontend', required=False)
+    parser.add_argument('--cache-dir', help='directory for caching processed assembly', required=False)
+    parser.add_argument('--cache-size', type=int, default=1024, help='maximum number of cached outputs',
+                        required=False)
+    parser.add_argument('--asm-index', help='index of processed functions, see asm_index.py', required=False)
+    parser.add_argument('--coalesce-dir', help='directory for coalescing identical concurrent requests',
+                        required=False)
+    parser.add_argument('--coalesce-timeout', type=float, default=30,
+                        help='seconds to wait for an identical request before compiling independently', required=False)
+    parser.add_argument('--repo', help='repository whose revision is part of the request identity', required=False)
+    parser.add_argument('--profile-dir', help='directory for sampled profiles, see profile_report.py',
+                        required=False)
+    parser.add_argument('--profile-rate', type=positive_int, default=1, help='profile one in N requests', required=False)
+    parser.add_argument('--record-dir', help='directory for recording requests, see replay.py', required=False)
+    # the unprocessed output of cc1 of a recorded request, for replaying it without cc1
+    parser.set_defaults(cc1_output=None)
+    parser.add_argument('--stats-file', help='file for the latency histograms of all requests', required=False)
+    parser.add_argument('--stats', action='store_true', help='print the latency histograms of the stats file',
+                        required=False)
+    parser.add_argument('--stats-reset', action='store_true', help='reset the latency histograms of the stats file',
+                        required=False)
+    parser.add_argument('--memory-profile', action='store_true',
+                        help='report peak and retained memory and the top allocation sites of every stage, implies '
+                             '--verbose (debug option)', required=False)
+    parser.add_argument('--variant', action='append',
+                        help='extra cc1 flags of a variant as --variant="-O2", --cc1=PATH selects another cc1; the source '
+                             'is preprocessed once and every variant is written to OUTPUT.N.s', required=False)
+    parser.add_argument('--prefix-cache',
+                        help='directory for snapshots of the leading include blocks of C sources, only the rest of a '
+                             'source is preprocessed, see prefix.py; off by default until prefix.py has been run on the '
+                             'repository', required=False)
+    parser.add_argument('--tree-shake', action='store_true',
+                        help='remove declarations of included files that the source does not use before running cc1, '
+                             'see treeshake.py; not yet checked against the repository, run treeshake.py check on it '
+                             'before turning it on', required=False)
+    parser.add_argument('--split', action='store_true',
+                        help='compile the functions of C sources concurrently, only used when the output is parsed, '
+                             'see split.py', required=False)
+    parser.add_argument('--function', action='append', dest='functions',
+                        help='only process the functions matching this glob pattern, can be given several times',
+                        required=False)
+    parser.add_argument('--chunked', action='store_true',
+                        help='process the assembly function by function, keeping unparsable functions unprocessed',
+                        required=False)
+    parser.add_argument('--grammar', choices=[grammar.name.lower() for grammar in Grammar], default='asm',
+                        help='assembly grammar, both produce the same output (debug option)', required=False)
+    parser.add_argument('--disable-pass', action='append', help='disable a transformation pass (debug option)',
+                        required=False)
+    parser.add_argument('--verbose', action='store_true', help='print diagnostics to stderr (debug option)',
+                        required=False)
     return parser.parse_known_args(argv)
 
 
-def compile(source, output_filename, args, remainder):
+def cpp_arguments(args):
     cpp_args = ["cpp", "-nostdinc", "-undef"]
 
     # Add Block Includes and Quote Includes
@@ -36,8 +114,23 @@ def compile(source, output_filename, args, remainder):
         for b in args.binclude:
             cpp_args += ["-I", b]
 
-    cpp_args += [source, "-o", source + ".i"]
-    subprocess.call(cpp_args)
+    if args.define:
+        for d in args.define:
+            cpp_args += ["-D", d]
+    return cpp_args
+
+
+def preprocess(source, args):
+    cpp_args = cpp_arguments(args)
+    if args.prefix_cache:
+        result = preprocess_prefix(cpp_args, source, source + '.i', args.prefix_cache)
+        report(args, 'prefix', result=result)
+        if result is not None:
+            return
+    subprocess.call(cpp_args + [source, "-o", source + ".i"])
+
+
+def compile(source, output_filename, args, remainder):
     if args.preproc and args.charmap:
         pprocess = subprocess.Popen([args.preproc, source + '.i', args.charmap], stdout=subprocess.PIPE)
         subprocess.call([args.cc1] + ['-o', output_filename] + remainder, stdin=pprocess.stdout)
@@ -46,50 +139,377 @@ def compile(source, output_filename, args, remainder):
             subprocess.call([args.cc1] + ['-o', output_filename] + remainder, stdin=a)
 
 
-def process_asm(input_filename, output_filename):
-    tree, success = parse(input_filename)
-    if not success:
+def preprocessed_text(source, args):
+    if args.preproc and args.charmap:
+        return subprocess.run([args.preproc, source + '.i', args.charmap], stdout=subprocess.PIPE).stdout
+    with open(source + '.i', 'rb') as f:
+        return f.read()
+
+
+def parse_variant(variant, cc1):
+    flags = []
+    words = iter(shlex.split(variant))
+    for word in words:
+        if word == '--cc1':
+            cc1 = next(words)
+        elif word.startswith('--cc1='):
+            cc1 = word[len('--cc1='):]
+        else:
+            flags.append(word)
+    return cc1, flags
+
+
+def variant_destination(destination, n):
+    base, extension = os.path.splitext(destination)
+    return f'{base}.{n}{extension}'
+
+
+def report(args, event, **fields):
+    if args.verbose:
+        print(json.dumps({'event': event, **fields}), file=sys.stderr)
+
+
+def process_asm(input_filename, output_filename, index=None, manager=None, chunked=False, grammar=Grammar.ASM):
+    if index is not None:
+        with open(input_filename, 'r') as f, timer.stage('index'):
+            output = index.normalize(f)
+        if output is not None:
+            with open(output_filename, 'w') as destination_file:
+                destination_file.write(output)
+            return 'index'
+    if chunked:
+        with open(input_filename, 'r') as f, open(output_filename, 'w') as destination_file, \
+                timer.stage('process_chunked'):
+            failed = process_chunked(f, destination_file, manager, grammar)
+        for name in failed:
+            print(f'error cleaning assembly code of {name}\nOutputting unprocessed assembly', file=sys.stderr)
+        return 'chunked'
+    # the caller falls back to the unprocessed assembly, so there is no point in error recovery
+    with timer.stage('parse'):
+        tree, stage = parse(input_filename, fail_fast=True, grammar=grammar)
+    if stage is None:
         raise ValueError('could not parse file')
-    ast = generate_ast(tree)
-    apply_transformations(ast)
-    with open(output_filename, 'w') as destination_file:
+    with timer.stage('generate_ast'):
+        ast = generate_ast(tree, manager)
+    # the parse tree is no longer needed
+    del tree
+    with timer.stage('apply_transformations'):
+        apply_transformations(ast, manager)
+    with open(output_filename, 'w') as destination_file, timer.stage('dump'):
         ASTDump(destination_file).visit(ast)
+    return stage.name
+
+
+def processing_options(manager=None, chunked=False, grammar=Grammar.ASM):
+    # everything besides the assembly that changes the processed output
+    disabled = sorted(manager.disabled) if manager is not None else []
+    return [grammar.name, 'chunked' if chunked else '', *disabled]
+
+
+def process_asm_cached(cache, input_filename, output_filename, index=None, manager=None, chunked=False,
+                       grammar=Grammar.ASM):
+    with open(input_filename, 'r') as f:
+        key = cache.key(f.read(), *processing_options(manager, chunked, grammar))
+    output = cache.get(key)
+    if output is not None:
+        with open(output_filename, 'w') as destination_file:
+            destination_file.write(output)
+        return 'cache'
+    result = process_asm(input_filename, output_filename, index, manager, chunked, grammar)
+    with open(output_filename, 'r') as f:
+        cache.put(key, f.read())
+    return result
+
+
+def file_stamp(path):
+    if path is None or not os.path.exists(path):
+        return ''
+    stat = os.stat(path)
+    return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def compile_key(cache, source, args, remainder, manager):
+    with open(source + '.i', 'r', errors='backslashreplace') as f:
+        # the line markers contain the path of the source file, which is different for every request
+        text = f.read().replace(source, '<source>')
+    return cache.key(text, *remainder, file_stamp(args.cc1), file_stamp(args.preproc), file_stamp(args.charmap),
+                     *(args.functions or []), 'tree-shake' if args.tree_shake else '', 'split' if args.split else '',
+                     *processing_options(manager, args.chunked, Grammar[args.grammar.upper()]))
+
+
+def select(asm_file, selected, patterns):
+    if not patterns:
+        return asm_file
+    # a textual pre-scan, so the other functions are never parsed
+    with open(asm_file, 'r') as f:
+        text, names = select_functions(f, patterns)
+    if not names:
+        raise ValueError(f'no function matches {" ".join(patterns)}')
+    with open(selected, 'w') as f:
+        f.write(text)
+    return selected
 
 
 def cleanup(args, source):
-    for file in [f'{source}.i', f'{args.destination}.tmp']:
+    for file in [f'{source}.i', f'{args.destination}.tmp', f'{args.destination}.functions']:
         if os.path.exists(file):
             os.remove(file)
 
 
-def main(argv):
+def save_profile(args, profiler):
+    os.makedirs(args.profile_dir, exist_ok=True)
+    filename = os.path.join(args.profile_dir, f'{time.time_ns()}-{os.getpid()}.pstats')
+    profiler.dump_stats(filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+PATH = re.compile(r'(?<![\w.])/(?:[^/\s]*/)+')
+SOURCE_DIRECTORY = '<source-dir>'
+WORKING_DIRECTORY = '<cwd>'
+
+
+def redact_paths(text, source):
+    if text is None:
+        return None
+    # the directory of the request is different every time, the working directory is the one of the server
+    directories = [(os.path.dirname(os.path.abspath(source)), SOURCE_DIRECTORY), (os.getcwd(), WORKING_DIRECTORY)]
+    for directory, placeholder in sorted(directories, key=lambda pair: -len(pair[0])):
+        if len(directory) > 1:
+            text = text.replace(directory, placeholder)
+    return text
+
+
+def record_request(args, flags, source, status_code, seconds):
+    with open(source, 'r', errors='replace') as f:
+        text = f.read()
+    output = None
+    if os.path.exists(args.destination):
+        with open(args.destination, 'r', errors='replace') as f:
+            output = f.read()
+    request = {
+        'flags': [PATH.sub('<path>/', flag) for flag in flags],
+        'language': 'c' if source.endswith('.c') else 'asm',
+        'source': redact_paths(text, source),
+        'output': redact_paths(output, source),
+        'cc1_output': redact_paths(args.cc1_output, source),
+        'status': status_code,
+        'seconds': seconds,
+    }
+    os.makedirs(args.record_dir, exist_ok=True)
+    filename = os.path.join(args.record_dir, f'{time.time_ns()}-{os.getpid()}.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(request, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def process_variant(asm_file, output_filename, index_filename, chunked, disabled, grammar, functions):
+    index = AsmIndex.open(index_filename) if index_filename else None
+    selected = output_filename + '.functions'
+    try:
+        process_debug_info(asm_file)
+        return process_asm(select(asm_file, selected, functions), output_filename, index,
+                           PassManager(disabled=disabled), chunked, grammar)
+    except Exception as e:
+        print(f'error cleaning assembly code: {e}\nOutputting unprocessed assembly', file=sys.stderr)
+        copyfile(asm_file, output_filename)
+        return None
+    finally:
+        if os.path.exists(selected):
+            os.remove(selected)
+
+
+def run_variants(args, remainder, source):
+    """
+    Runs cpp and preproc once and compiles the same text with every variant.
+    cc1 runs on threads, the assembly is processed in worker processes as soon as a variant is compiled.
+    """
+    variants = [parse_variant(variant, args.cc1) for variant in args.variant]
+    destinations = [variant_destination(args.destination, n) for n in range(len(variants))]
+    try:
+        preprocess(source, args)
+        if args.tree_shake:
+            shake_file(source + '.i')
+        text = preprocessed_text(source, args)
+
+        def compile_variant(n):
+            cc1, flags = variants[n]
+            asm_file = destinations[n] + '.tmp'
+            subprocess.run([cc1] + ['-o', asm_file] + remainder + flags, input=text)
+            if args.no_parse:
+                copyfile(asm_file, destinations[n])
+                return 'no_parse'
+            return processes.submit(process_variant, asm_file, destinations[n], args.asm_index, args.chunked,
+                                    args.disable_pass or [], Grammar[args.grammar.upper()],
+                                    args.functions).result()
+
+        with ProcessPoolExecutor(max_workers=min(len(variants), os.cpu_count() or 1)) as processes, \
+                ThreadPoolExecutor(max_workers=len(variants)) as threads:
+            results = list(threads.map(compile_variant, range(len(variants))))
+        for n, result in enumerate(results):
+            report(args, 'process_asm', variant=n, output=destinations[n], result=result)
+        if os.path.exists(destinations[0]):
+            # the output of the first variant is the output of the request, e.g. for the sidecar
+            copyfile(destinations[0], args.destination)
+        return 0 if None not in results else 1
+    finally:
+        cleanup(args, source)
+        for destination in destinations:
+            if os.path.exists(destination + '.tmp'):
+                os.remove(destination + '.tmp')
+
+
+def repo_revision(path):
+    git_proc = subprocess.run(['git', '--git-dir=' + path + '/.git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE)
+    return git_proc.stdout.decode('utf-8').strip()
+
+
+def request_identity(args, argv, source):
+    with open(source, 'r', errors='surrogateescape') as f:
+        text = f.read()
+    # the output and source paths are different for every request
+    options = [option for option in argv if option not in (args.destination, source)]
+    revision = repo_revision(args.repo) if args.repo else ''
+    return [text, os.path.splitext(source)[1], revision] + options
+
+
+def run(args, remainder):
     status_code = 0
-    args, remainder = parse_args(argv)
-    if args.version:
-        git_proc = subprocess.run(['git', '--git-dir=' + args.version + '/.git', 'rev-parse', '--short', 'HEAD'],
-                                  stdout=subprocess.PIPE)
-        print("pycc frontend for agbcc1 " + os.path.basename(args.version) + "@" + git_proc.stdout.decode('utf-8'))
-        exit(0)
     source = remainder.pop(-1)
+    if args.variant and source.endswith('.c'):
+        return run_variants(args, remainder, source)
+    cache = OutputCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+    index = AsmIndex.open(args.asm_index) if args.asm_index else None
+    manager = PassManager(disabled=args.disable_pass or [])
+    grammar = Grammar[args.grammar.upper()]
+    key = None
     try:
         if source.endswith('.c'):
+            with timer.stage('preprocess'):
+                preprocess(source, args)
+            if cache is not None and not args.no_parse:
+                key = compile_key(cache, source, args, remainder, manager)
+                output = cache.get(key)
+                if output is not None:
+                    with open(args.destination, 'w') as destination_file:
+                        destination_file.write(output)
+                    report(args, 'process_asm', result='cache')
+                    timer.event('cache_hit')
+                    return 0
+            if args.tree_shake:
+                with timer.stage('tree_shake'):
+                    removed = shake_file(source + '.i')
+                report(args, 'tree_shake', removed=removed)
             asm_file = args.destination + '.tmp'
-            compile(source, asm_file, args, remainder)
-            process_debug_info(asm_file)
+            with timer.stage('cc1'):
+                # label numbers and section switches of split output differ, which processing removes, the
+                # assembly of cc1 is only the same up to them, see split.py --raw
+                split = args.split and compile_split(args.cc1, remainder, preprocessed_text(source, args), asm_file)
+                if not split:
+                    compile(source, asm_file, args, remainder)
+            report(args, 'cc1', split=split)
+            if args.record_dir and os.path.exists(asm_file):
+                with open(asm_file, 'r', errors='replace') as f:
+                    args.cc1_output = f.read()
+            with timer.stage('debug_info'):
+                process_debug_info(asm_file)
         else:
             asm_file = source
 
         if not args.no_parse:
             try:
-                process_asm(asm_file, args.destination)
+                with timer.stage('process_asm'):
+                    selected = select(asm_file, args.destination + '.functions', args.functions)
+                    if cache is not None and asm_file == source:
+                        result = process_asm_cached(cache, selected, args.destination, index, manager, args.chunked,
+                                                    grammar)
+                    else:
+                        result = process_asm(selected, args.destination, index, manager, args.chunked, grammar)
+                        if key is not None:
+                            with open(args.destination, 'r') as f:
+                                cache.put(key, f.read())
+                report(args, 'process_asm', result=result)
+                if cache is not None:
+                    timer.event('cache_hit' if result == 'cache' else 'cache_miss')
+                if result == 'index':
+                    timer.event('index_hit')
+                if manager.timings:
+                    report(args, 'passes', timings=manager.timings)
             except Exception as e:
                 print(f'error cleaning assembly code: {e}\nOutputting unprocessed assembly', file=sys.stderr)
                 copyfile(asm_file, args.destination)
+                timer.event('fallback')
                 status_code = 1
         else:
             copyfile(asm_file, args.destination)
     finally:
         cleanup(args, source)
+    return status_code
+
+
+def write_sidecar(destination, processed):
+    sidecar = destination + '.json'
+    if not processed:
+        # unprocessed assembly is parsed by the frontend itself
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        return
+    with open(destination, 'r') as f:
+        lines = line_map(f)
+    with open(sidecar, 'w') as f:
+        json.dump(lines, f, separators=(',', ':'))
+
+
+def main(argv):
+    args, remainder = parse_args(argv)
+    if args.version:
+        git_proc = subprocess.run(['git', '--git-dir=' + args.version + '/.git', 'rev-parse', '--short', 'HEAD'],
+                                  stdout=subprocess.PIPE)
+        print("pycc frontend for agbcc1 " + os.path.basename(args.version) + "@" + git_proc.stdout.decode('utf-8'))
+        exit(0)
+    if args.stats or args.stats_reset:
+        if not args.stats_file:
+            print('--stats and --stats-reset need --stats-file', file=sys.stderr)
+            exit(2)
+        store = HistogramStore(args.stats_file)
+        if args.stats:
+            print_histograms(store.read())
+        if args.stats_reset:
+            store.reset()
+        exit(0)
+    flags = remainder[:-1]
+    source = remainder[-1]
+    if args.memory_profile:
+        args.verbose = True
+        timer.profile_memory()
+    profiler = None
+    if args.profile_dir and random.randrange(args.profile_rate) == 0:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        # only -o is shared with the followers, not the outputs of the variants
+        if args.coalesce_dir and not (args.variant and source.endswith('.c')):
+            singleflight = Singleflight(args.coalesce_dir, args.coalesce_timeout)
+            key = singleflight.key(*request_identity(args, argv, source))
+            status_code = singleflight.run(key, args.destination, lambda: run(args, remainder))
+        else:
+            status_code = run(args, remainder)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            save_profile(args, profiler)
+    if args.sidecar and args.destination:
+        with timer.stage('sidecar'):
+            write_sidecar(args.destination, status_code == 0 and not args.no_parse and
+                          os.path.exists(args.destination))
+    for stage in timer.memory or []:
+        report(args, 'memory', **stage)
+    if args.stats_file:
+        timer.timings['total'] = time.perf_counter() - start
+        timer.event('requests')
+        HistogramStore(args.stats_file).record(timer.timings, timer.events)
+    if args.record_dir:
+        record_request(args, flags, source, status_code, time.perf_counter() - start)
     exit(status_code)
 
 
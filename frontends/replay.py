@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from prewarm import compiler_options
+from pycc import parse_args, SOURCE_DIRECTORY, WORKING_DIRECTORY
+
+PYCC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pycc.py')
+
+
+def load_requests(directory: str) -> List[Tuple[str, dict]]:
+    requests = []
+    for file in sorted(os.listdir(directory)):
+        if file.endswith('.json'):
+            with open(os.path.join(directory, file), 'r') as f:
+                requests.append((file, json.load(f)))
+    return requests
+
+
+def pycc_options(options: List[str]) -> List[str]:
+    """
+    Removes the cc1 flags from compiler options, the recorded requests already contain them.
+    """
+    _, flags = parse_args(options)
+    return [option for option in options if option not in flags]
+
+
+def without_options(options: List[str], names: List[str]) -> List[str]:
+    result = []
+    skip = False
+    for option in options:
+        if skip:
+            skip = False
+        elif option in names:
+            skip = True
+        elif option.split('=', 1)[0] not in names:
+            result.append(option)
+    return result
+
+
+def restore_paths(text: str, directory: str) -> str:
+    return text.replace(SOURCE_DIRECTORY, directory).replace(WORKING_DIRECTORY, os.getcwd())
+
+
+def fake_cc1(directory: str, output: str) -> str:
+    # cc1 is called as cc1 -o <output> <flags>
+    with open(os.path.join(directory, 'recorded.s'), 'w') as f:
+        f.write(restore_paths(output, directory))
+    script = os.path.join(directory, 'cc1')
+    with open(script, 'w') as f:
+        f.write(f'#!/bin/sh\ncat > /dev/null\ncp "{directory}/recorded.s" "$2"\n')
+    os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+    return script
+
+
+def replay(request: dict, options: List[str], fake: bool) -> Tuple[float, int, str]:
+    with tempfile.TemporaryDirectory(prefix='replay') as directory:
+        source = os.path.join(directory, 'example.c' if request['language'] == 'c' else 'example.s')
+        with open(source, 'w') as f:
+            f.write(restore_paths(request['source'], directory))
+        if fake and request['language'] == 'c':
+            options = options + ['--cc1', fake_cc1(directory, request['cc1_output'])]
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, PYCC] + options + request['flags'] +
+                                 ['-o', os.path.join(directory, 'output.s'), '-S', source],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        seconds = time.perf_counter() - start
+        return seconds, process.returncode, process.stderr.decode(errors='replace')
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay recorded pycc requests')
+    parser.add_argument('directory', help='directory with the recorded requests')
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('-j', '--concurrency', type=int, default=os.cpu_count(), help='concurrent requests',
+                        required=False)
+    parser.add_argument('--repeat', type=int, default=1, help='replay every request this many times', required=False)
+    parser.add_argument('--fake-cc1', action='store_true',
+                        help='replace cc1 by the recorded cc1 output, C requests without one are not replayed',
+                        required=False)
+    parser.add_argument('--slow-threshold', type=float, help='latency in seconds of slow requests', required=False)
+    parser.add_argument('--slow-dir', default='slow', help='directory to capture slow requests in',
+                        required=False)
+    args, options = parser.parse_known_args(argv)
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+    options = without_options(pycc_options(options), ['--record-dir'])
+    if args.fake_cc1:
+        # the recorded output already went through the charmap preprocessor
+        options = without_options(options, ['--cc1', '--preproc', '--charmap'])
+
+    requests = load_requests(args.directory)
+    if args.fake_cc1:
+        # cache hits and coalesced requests did not run cc1, requests of older versions did not record its output
+        replayable = [(file, request) for file, request in requests
+                      if request['language'] != 'c' or request.get('cc1_output') is not None]
+        print(f'{len(requests) - len(replayable)} C requests without cc1 output skipped', file=sys.stderr)
+        requests = replayable
+    requests = [(n, file, request) for n in range(args.repeat) for file, request in requests]
+    if not requests:
+        print(f'no requests to replay in {args.directory}', file=sys.stderr)
+        sys.exit(1)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda request: replay(request[2], options, args.fake_cc1), requests))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted([seconds for seconds, returncode, errors in results])
+    failed = len([returncode for seconds, returncode, errors in results if returncode != 0])
+    print(f'{len(results)} requests in {elapsed:.2f}s, {len(results) / elapsed:.1f} requests/s, {failed} failed')
+    print(f'latency p50 {percentile(latencies, 50) * 1000:.0f}ms, p90 {percentile(latencies, 90) * 1000:.0f}ms, '
+          f'p99 {percentile(latencies, 99) * 1000:.0f}ms, max {latencies[-1] * 1000:.0f}ms')
+
+    if args.slow_threshold is not None:
+        slow = 0
+        for (n, file, request), (seconds, returncode, errors) in zip(requests, results):
+            if seconds > args.slow_threshold:
+                os.makedirs(args.slow_dir, exist_ok=True)
+                # every repetition of a request is captured on its own
+                name, extension = os.path.splitext(file)
+                with open(os.path.join(args.slow_dir, f'{name}.{n}{extension}'), 'w') as f:
+                    json.dump({**request, 'replay_seconds': seconds, 'replay_status': returncode,
+                               'replay_errors': errors}, f)
+                slow += 1
+        print(f'{slow} requests slower than {args.slow_threshold}s captured in {args.slow_dir}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
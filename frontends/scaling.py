@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Callable, Dict, List, Tuple
+
+import antlr4
+from antlr4.error.ErrorStrategy import BailErrorStrategy
+
+from parser import parse_string, ASTGenerator, ASTDump, PassManager, normalize, Grammar, create_lexer, \
+    create_parser, generate_ast, open_stream, text_stream
+
+PARAMETERS = ['functions', 'instructions', 'label_density', 'jump_table', 'literal_pool']
+DEFAULTS = {'functions': 20, 'instructions': 200, 'label_density': 0.1, 'jump_table': 8, 'literal_pool': 8}
+# exponents above this are reported as quadratic behavior
+QUADRATIC = 1.5
+
+
+def generate_function(rng: random.Random, n: int, instructions: int, label_density: float, jump_table: int,
+                      literal_pool: int) -> str:
+    labels = [f'.L{n}_{i}' for i in range(max(1, round(instructions * label_density)))]
+    cases = [f'.L{n}_case{i}' for i in range(jump_table)]
+    lines = [
+        '\t.align\t2, 0',
+        f'\t.globl\tfunc_{n}',
+        f'\t.type\t func_{n},function',
+        '\t.thumb_func',
+        f'func_{n}:',
+        '\tpush\t{r4, r5, r6, lr}',
+    ]
+    placed = 0
+    for i in range(instructions):
+        # spread the labels evenly over the body
+        if placed < len(labels) and i >= placed * instructions / len(labels):
+            lines.append(f'{labels[placed]}:')
+            placed += 1
+        rd = rng.randrange(7)
+        rn = rng.randrange(7)
+        kind = rng.randrange(8)
+        if kind == 0:
+            lines.append(f'\tadd\tr{rd}, r{rn}, #{rng.randrange(8)}')
+        elif kind == 1:
+            lines.append(f'\tsub\tr{rd}, r{rn}, r{rng.randrange(7)}')
+        elif kind == 2:
+            lines.append(f'\tmov\tr{rd}, #{rng.randrange(256)}')
+        elif kind == 3:
+            lines.append(f'\tcmp\tr{rd}, #{rng.randrange(256)}')
+        elif kind == 4:
+            lines.append(f'\tldrb\tr{rd}, [r{rn}, #{rng.randrange(32)}]')
+        elif kind == 5:
+            lines.append(f'\tstr\tr{rd}, [r{rn}]')
+        elif kind == 6:
+            lines.append(f'\tbeq\t{rng.choice(labels)}')
+        elif literal_pool:
+            lines.append(f'\tldr\tr{rd}, .L{n}_pool+{4 * rng.randrange(literal_pool)}')
+        else:
+            lines.append(f'\tlsl\tr{rd}, r{rn}, #{rng.randrange(32)}')
+    if jump_table:
+        lines += [
+            '\tlsl\tr0, r0, #0x2',
+            f'\tldr\tr1, .L{n}_table',
+            '\tadd\tr0, r0, r1',
+            '\tldr\tr0, [r0]',
+            '\tmov\tpc, r0',
+            '\t.align\t2, 0',
+            f'.L{n}_table:',
+        ]
+        lines += [f'\t.word\t{case}' for case in cases]
+        for case in cases:
+            lines += [f'{case}:', f'\tmov\tr0, #{rng.randrange(256)}', f'\tb\t{labels[-1]}']
+    lines += ['\tpop\t{r4, r5, r6}', '\tpop\t{r0}', '\tbx\tr0']
+    if literal_pool:
+        lines += ['\t.align\t2, 0', f'.L{n}_pool:']
+        lines += [f'\t.word\tgSymbol_{rng.randrange(1000)}' for _ in range(literal_pool)]
+    lines += [f'.L{n}_end:', f'\t.size\t func_{n},.L{n}_end-func_{n}']
+    return '\n'.join(lines) + '\n'
+
+
+def generate(functions: int, instructions: int, label_density: float, jump_table: int, literal_pool: int,
+             seed: int = 0) -> str:
+    """
+    Generates grammar-valid agbcc style assembly.
+    """
+    rng = random.Random(seed)
+    text = '\t.code\t16\n'
+    for n in range(functions):
+        text += generate_function(rng, n, instructions, label_density, jump_table, literal_pool)
+    return text
+
+
+def time_stages(text: str) -> Dict[str, float]:
+    timings = {}
+    start = time.perf_counter()
+
+    def stage(name: str):
+        nonlocal start
+        end = time.perf_counter()
+        timings[name] = end - start
+        start = end
+
+    tree, parse_stage = parse_string(text)
+    if parse_stage is None:
+        raise ValueError('generated assembly could not be parsed')
+    stage('parse')
+    ast = ASTGenerator().visit(tree)
+    stage('ASTGenerator')
+    # time every analysis and pass on its own
+    manager = PassManager(fuse=False)
+    manager.prepare(ast)
+    manager.run(ast)
+    timings.update(manager.timings)
+    start = time.perf_counter()
+    ASTDump(StringIO()).visit(ast)
+    stage('ASTDump')
+    return timings
+
+
+def fit_exponent(sizes: List[float], timings: List[float]) -> float:
+    # least squares fit of log(time) = k * log(size) + c
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(timing, 1e-9)) for timing in timings]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    variance = sum([(x - mx) ** 2 for x in xs])
+    if variance == 0:
+        return 0.0
+    return sum([(x - mx) * (y - my) for x, y in zip(xs, ys)]) / variance
+
+
+def sweep(parameter: str, values: List[float], base: Dict[str, float], repeat: int, seed: int = 0):
+    results = []
+    for value in values:
+        params = {**base, parameter: value}
+        text = generate(int(params['functions']), int(params['instructions']), params['label_density'],
+                        int(params['jump_table']), int(params['literal_pool']), seed)
+        runs = [time_stages(text) for _ in range(repeat)]
+        results.append({name: min([run[name] for run in runs]) for name in runs[0]})
+
+    print(f'sweep of {parameter}')
+    stages = list(results[0])
+    print(f'{"stage":<20}' + ''.join([f'{value:>10g}' for value in values]) + '  exponent')
+    for name in stages:
+        timings = [result[name] for result in results]
+        exponent = fit_exponent(values, timings)
+        flag = '  QUADRATIC' if exponent > QUADRATIC and timings[-1] > 1e-3 else ''
+        print(f'{name:<20}' + ''.join([f'{timing * 1000:>8.1f}ms' for timing in timings]) +
+              f'{exponent:>10.2f}{flag}')
+    print()
+
+
+def time_grammar(text: str, grammar: Grammar) -> Tuple[float, float, float]:
+    start = time.perf_counter()
+    tokens = antlr4.CommonTokenStream(create_lexer(text_stream(text), grammar))
+    tokens.fill()
+    lexed = time.perf_counter()
+    parser = create_parser(tokens, grammar)
+    parser._interp.predictionMode = antlr4.PredictionMode.SLL
+    parser._errHandler = BailErrorStrategy()
+    parser.removeErrorListeners()
+    tree = parser.asmfile()
+    parsed = time.perf_counter()
+    generate_ast(tree)
+    return lexed - start, parsed - lexed, time.perf_counter() - parsed
+
+
+def benchmark_grammars(text: str, repeat: int):
+    lines = text.count('\n')
+    print(f'{lines} lines, {len(text) / 1024:.0f} KiB')
+    print(f'{"grammar":<10}{"lex cold":>10}{"lex warm":>10}{"parse cold":>12}{"parse warm":>12}{"ast":>10}'
+          f'{"lines/s warm":>14}')
+    for grammar in Grammar:
+        # the DFA caches are per thread, so a new thread starts cold
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            cold = executor.submit(time_grammar, text, grammar).result()
+        runs = [time_grammar(text, grammar) for _ in range(repeat)]
+        lex, parse, ast = [min([run[i] for run in runs]) for i in range(3)]
+        print(f'{grammar.name.lower():<10}{cold[0] * 1000:>8.1f}ms{lex * 1000:>8.1f}ms{cold[1] * 1000:>10.1f}ms'
+              f'{parse * 1000:>10.1f}ms{ast * 1000:>8.1f}ms{lines / (lex + parse):>14.0f}')
+    outputs = {normalize(text, debug=False, grammar=grammar) for grammar in Grammar}
+    print('same output for all grammars' if len(outputs) == 1 else 'DIFFERENT OUTPUT')
+
+
+def lex(stream: antlr4.InputStream) -> List[Tuple[int, str]]:
+    tokens = antlr4.CommonTokenStream(create_lexer(stream))
+    tokens.fill()
+    return [(token.type, token.text) for token in tokens.tokens]
+
+
+def benchmark_streams(path: str, repeat: int):
+    streams: Dict[str, Callable[[], antlr4.InputStream]] = {
+        'FileStream': lambda: antlr4.FileStream(path),
+        'mmap': lambda: open_stream(path),
+    }
+    with open(path, 'rb') as f:
+        size = len(f.read())
+    print(f'{size / 1024:.0f} KiB')
+    print(f'{"stream":<12}{"memory":>12}{"open":>10}{"lex":>10}{"KiB/s":>10}')
+    outputs = []
+    for name, create in streams.items():
+        # the memory of the stream itself, the tokens are the same for both
+        tracemalloc.start()
+        stream = create()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del stream
+        opened = min([timed(create)[1] for _ in range(repeat)])
+        # the first run fills the DFA cache
+        outputs.append(lex(create()))
+        lexed = min([timed(lambda: lex(create()))[1] for _ in range(repeat)])
+        print(f'{name:<12}{memory / 1024:>10.0f}KiB{opened * 1000:>8.1f}ms{lexed * 1000:>8.1f}ms'
+              f'{size / 1024 / lexed:>10.0f}')
+    print('same tokens for all streams' if all([output == outputs[0] for output in outputs]) else 'DIFFERENT TOKENS')
+
+
+def timed(function: Callable):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def stress(base: Dict[str, float], inputs: int, threads: int, rounds: int) -> int:
+    """
+    Normalizes differently shaped inputs concurrently and compares against the sequential results.
+    Returns the number of mismatching outputs.
+    """
+    texts = []
+    for seed in range(inputs):
+        rng = random.Random(seed)
+        texts.append(generate(int(base['functions']), rng.randrange(1, int(base['instructions']) + 1),
+                              rng.uniform(0.01, 0.5), rng.randrange(int(base['jump_table']) + 1),
+                              rng.randrange(int(base['literal_pool']) + 1), seed))
+    expected = [normalize(text, debug=False) for text in texts]
+    jobs = [n for _ in range(rounds) for n in range(inputs)]
+    random.Random(0).shuffle(jobs)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        outputs = list(executor.map(lambda n: normalize(texts[n], debug=False), jobs))
+    return len([n for n, output in zip(jobs, outputs) if output != expected[n]])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate synthetic assembly and measure how the stages scale')
+    parser.add_argument('command', choices=['generate', 'sweep', 'stress', 'grammars', 'streams'])
+    for name in PARAMETERS:
+        parser.add_argument(f'--{name.replace("_", "-")}', type=float, default=DEFAULTS[name], required=False)
+    parser.add_argument('--parameter', choices=PARAMETERS, action='append',
+                        help='parameter to sweep, all parameters by default', required=False)
+    parser.add_argument('--steps', type=int, default=4, help='number of doublings of the swept parameter',
+                        required=False)
+    parser.add_argument('--repeat', type=int, default=3, help='measurements per size, the fastest is used',
+                        required=False)
+    parser.add_argument('--seed', type=int, default=0, required=False)
+    parser.add_argument('--input', help='assembly file for the grammar and stream benchmarks instead of generated assembly',
+                        required=False)
+    parser.add_argument('--threads', type=int, default=8, help='threads of the stress test', required=False)
+    parser.add_argument('--inputs', type=int, default=16, help='different inputs of the stress test', required=False)
+    args = parser.parse_args(argv)
+    base = {name: getattr(args, name) for name in PARAMETERS}
+
+    if args.command == 'generate':
+        sys.stdout.write(generate(int(base['functions']), int(base['instructions']), base['label_density'],
+                                  int(base['jump_table']), int(base['literal_pool']), args.seed))
+        return
+    if args.command == 'grammars':
+        if args.input:
+            with open(args.input, 'r') as f:
+                text = f.read()
+        else:
+            text = generate(int(base['functions']), int(base['instructions']), base['label_density'],
+                            int(base['jump_table']), int(base['literal_pool']), args.seed)
+        benchmark_grammars(text, args.repeat)
+        return
+    if args.command == 'streams':
+        if args.input:
+            benchmark_streams(args.input, args.repeat)
+            return
+        with tempfile.NamedTemporaryFile('w', suffix='.s') as f:
+            f.write(generate(int(base['functions']), int(base['instructions']), base['label_density'],
+                             int(base['jump_table']), int(base['literal_pool']), args.seed))
+            f.flush()
+            benchmark_streams(f.name, args.repeat)
+        return
+    if args.command == 'stress':
+        mismatches = stress(base, args.inputs, args.threads, args.repeat)
+        print(f'{args.inputs * args.repeat} concurrent normalizations, {mismatches} mismatches')
+        sys.exit(1 if mismatches else 0)
+    for parameter in args.parameter or PARAMETERS:
+        start = base[parameter] / 2 if parameter == 'label_density' else base[parameter]
+        sweep(parameter, [start * 2 ** step for step in range(args.steps)], base, args.repeat, args.seed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
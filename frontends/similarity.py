@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from asm_index import find_sources as find_assembly
+from cache import parser_version
+from parser import parse_string, generate_ast, apply_transformations, split_functions, PassManager, Directive, LABEL
+from prewarm import compiler_options, find_sources as find_c_sources
+
+PYCC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pycc.py')
+# operands are reduced to their kind, the registers that have a fixed role are kept
+OPERAND = re.compile(r'\b(?:r\d+|sb|sl|ip|sp|lr|pc)\b|#?-?(?:0x[0-9a-fA-F]+|\d+)\b|(?<![\w.$])[A-Za-z_.$][\w.$]*')
+FIXED_REGISTERS = {'sp', 'lr', 'pc'}
+NUM_PERM = 128
+NGRAM = 3
+# Mersenne prime for the permutations, the shingles are 32 bit so the products fit into 64 bit
+PRIME = (1 << 31) - 1
+SEED = 0
+INDEX_VERSION = 2
+
+
+class Entry(NamedTuple):
+    name: str
+    file: str
+    length: int
+    signature: np.ndarray
+
+
+def operand_kind(match: re.Match) -> str:
+    text = match.group(0)
+    if text[0] == '#' or text[0].isdigit() or text[0] == '-':
+        return 'i'
+    if text in FIXED_REGISTERS:
+        return text
+    if text[0] == 'r' and text[1:].isdigit() or text in {'sb', 'sl', 'ip'}:
+        return 'r'
+    return 's'
+
+
+def shape(instruction) -> Optional[str]:
+    """
+    The mnemonic and operand kinds of an instruction, e.g. ldrb r, [r, i]. Labels are only kept as block boundaries.
+    """
+    if isinstance(instruction, Directive):
+        return None
+    if isinstance(instruction, LABEL):
+        return f'{instruction.type.name.lower()}:'
+    mnemonic, _, operands = str(instruction).partition(' ')
+    return f'{mnemonic} {OPERAND.sub(operand_kind, operands)}'
+
+
+def function_shapes(text: str) -> List[Tuple[str, List[str]]]:
+    """
+    Processes assembly like normalize and returns the shape stream of every function.
+    Raises ValueError if the assembly cannot be parsed.
+    """
+    tree, stage = parse_string(text)
+    if stage is None:
+        raise ValueError('could not parse assembly')
+    manager = PassManager()
+    ast = generate_ast(tree, manager)
+    apply_transformations(ast, manager)
+    functions = []
+    for function in ast.functions:
+        shapes = [shape(instruction) for instruction in function.instructions]
+        functions.append((function.name, [s for s in shapes if s is not None]))
+    return functions
+
+
+def permutations() -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(SEED)
+    a = rng.integers(1, PRIME, NUM_PERM, dtype=np.uint64)
+    b = rng.integers(0, PRIME, NUM_PERM, dtype=np.uint64)
+    return a, b
+
+
+PERMUTATIONS = permutations()
+
+
+def signature(shapes: List[str]) -> np.ndarray:
+    """
+    MinHash signature of the n-grams of a shape stream.
+    """
+    n = min(NGRAM, len(shapes)) or 1
+    shingles = {zlib.crc32('\n'.join(shapes[i:i + n]).encode()) for i in range(max(1, len(shapes) - n + 1))}
+    values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    a, b = PERMUTATIONS
+    hashes = (values[:, None] * a[None, :] + b[None, :]) % PRIME
+    return hashes.min(axis=0).astype(np.uint32)
+
+
+def compile_c(options: List[str], path: str) -> Optional[str]:
+    with tempfile.TemporaryDirectory(prefix='similarity') as directory:
+        output = os.path.join(directory, 'output.s')
+        subprocess.run([sys.executable, PYCC] + options + ['--no-parse', '-o', output, '-S', os.path.abspath(path)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not os.path.exists(output):
+            return None
+        with open(output, 'r', errors='replace') as f:
+            return f.read()
+
+
+def read_assembly(options: List[str], path: str) -> Optional[str]:
+    if path.endswith('.c'):
+        return compile_c(options, path)
+    with open(path, 'r', errors='replace') as f:
+        return f.read()
+
+
+def file_entries(options: List[str], path: str) -> Tuple[List[Entry], int]:
+    text = read_assembly(options, path)
+    if text is None:
+        return [], 1
+    entries = []
+    failed = 0
+    for name, function in split_functions(text.splitlines(True)):
+        if name is None:
+            continue
+        try:
+            functions = function_shapes(function)
+        except Exception:
+            failed += 1
+            continue
+        entries += [Entry(name, path, len(shapes), signature(shapes)) for name, shapes in functions if shapes]
+    return entries, failed
+
+
+def find_sources(directories: Iterable[str]) -> List[str]:
+    sources = []
+    for directory in directories:
+        sources += find_c_sources(directory) + find_assembly(directory)
+    return sources
+
+
+def build(directories: List[str], filename: str, options: List[str], jobs: Optional[int] = None) -> Tuple[int, int]:
+    entries = []
+    failed = 0
+    sources = find_sources(directories)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for found, file_failed in executor.map(file_entries, [options] * len(sources), sources, chunksize=4):
+            entries += found
+            failed += file_failed
+    write(filename, entries, os.path.commonpath([os.path.abspath(d) for d in directories]))
+    return len(entries), failed
+
+
+def write(filename: str, entries: List[Entry], root: str):
+    tmp = f'{filename}.{os.getpid()}.tmp.npz'
+    np.savez(tmp,
+             version=np.array([INDEX_VERSION, NUM_PERM, NGRAM, SEED], dtype=np.int64),
+             parser=np.array(parser_version()),
+             signatures=np.stack([entry.signature for entry in entries]) if entries else
+             np.zeros((0, NUM_PERM), dtype=np.uint32),
+             names=np.array([entry.name for entry in entries], dtype=str),
+             files=np.array([os.path.relpath(os.path.abspath(entry.file), root) for entry in entries], dtype=str),
+             lengths=np.array([entry.length for entry in entries], dtype=np.int32))
+    os.replace(tmp, filename)
+
+
+class SimilarityIndex:
+    signatures: np.ndarray
+    names: np.ndarray
+    files: np.ndarray
+    lengths: np.ndarray
+
+    def __init__(self, signatures: np.ndarray, names: np.ndarray, files: np.ndarray, lengths: np.ndarray):
+        self.signatures = signatures
+        self.names = names
+        self.files = files
+        self.lengths = lengths
+
+    @staticmethod
+    def open(filename: str) -> Optional['SimilarityIndex']:
+        try:
+            data = np.load(filename, allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # signatures of other parameters or another version of the processing cannot be compared
+        if list(data['version']) != [INDEX_VERSION, NUM_PERM, NGRAM, SEED] or str(data['parser']) != parser_version():
+            return None
+        return SimilarityIndex(data['signatures'], data['names'], data['files'], data['lengths'])
+
+    def query(self, signature: np.ndarray, k: int) -> List[Tuple[float, str, str, int]]:
+        """
+        The k functions with the highest estimated Jaccard similarity, as (similarity, name, file, length).
+        """
+        if len(self.names) == 0:
+            return []
+        similarities = (self.signatures == signature).mean(axis=1)
+        k = min(k, len(similarities))
+        best = np.argpartition(-similarities, k - 1)[:k]
+        best = best[np.argsort(-similarities[best], kind='stable')]
+        return [(float(similarities[i]), str(self.names[i]), str(self.files[i]), int(self.lengths[i])) for i in best]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Find the functions of the repository that are most similar to the '
+                                                 'functions of a C or assembly file. Unknown options are passed to '
+                                                 'pycc for C files.')
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('index', help='index file')
+    parser.add_argument('paths', nargs='+',
+                        help='C and assembly source directories for build, a C or assembly file for query')
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('-k', type=int, default=10, help='number of matches per function', required=False)
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes', required=False)
+    args, options = parser.parse_known_args(argv)
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+
+    if args.command == 'build':
+        count, failed = build(args.paths, args.index, options, args.jobs)
+        print(f'indexed {count} functions, {failed} files or functions could not be processed')
+        return
+
+    index = SimilarityIndex.open(args.index)
+    if index is None:
+        print(f'{args.index} is missing or was built by another version', file=sys.stderr)
+        sys.exit(2)
+    for path in args.paths:
+        entries, failed = file_entries(options, path)
+        if failed:
+            print(f'{path}: {failed} files or functions could not be processed', file=sys.stderr)
+        for entry in entries:
+            print(f'{entry.name} ({entry.length} instructions)')
+            for similarity, name, file, length in index.query(entry.signature, args.k):
+                print(f'  {similarity:5.2f}  {name:<40} {file} ({length})')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
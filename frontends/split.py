@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Set, Tuple
+
+from cunits import Item, split_items
+from matchcheck import check_flag_sources
+from parse_debug import insert_debug_info
+from prewarm import compiler_options
+
+# top level asm statements are output in order, they mark where the functions of the units belong
+MARKER = '@pycc_split'
+# the switches in and out of inline assembly, newer versions of gcc also add line markers
+APP = re.compile(r'\s*([#@](NO_)?APP|# \d+ "[^"]*" \d+)\s*$')
+APP_SWITCH = re.compile(r'\s*[#@](NO_)?APP\s*$')
+SECTION = re.compile(r'\s*(\.text|\.data|\.bss|\.section\s.*)\s*$')
+LOCAL_LABEL = re.compile(r'(\.L[A-Z]*)(\d+)\b')
+# the local labels of every unit are moved to their own range
+LABEL_STRIDE = 1000000
+INLINE = {'inline', '__inline', '__inline__'}
+# these let cc1 inline functions that the units only declare
+INLINING_FLAGS = {'-O3', '-finline-functions'}
+# every request runs its own units, compiler explorer runs many requests at the same time
+DEFAULT_JOBS = 4
+
+
+class Units(NamedTuple):
+    # all declarations, data and static functions, with markers where the split functions were
+    rest: str
+    functions: List[str]
+    static_names: Set[str]
+
+
+def specifiers(item: Item) -> Set[str]:
+    return {token.text for token in item.tokens[:next(i for i, token in enumerate(item.tokens) if token.text == '(')]}
+
+
+def declaration(item: Item, text: str, suffix: str = '') -> str:
+    # the definition without its body, with the line breaks of the body so line numbers stay the same
+    body = next(token for token in item.tokens if token.text == '{')
+    return text[item.start:body.start] + ';' + suffix + '\n' * text.count('\n', body.start, item.end)
+
+
+def split_units(text: str, flags: List[str]) -> Optional[Units]:
+    """
+    Splits a preprocessed translation unit into a unit with everything but the non-static functions and a unit per
+    non-static function. Every unit keeps all declarations and data, so the functions compile the same way.
+    Returns None if the functions could compile differently on their own.
+    """
+    if INLINING_FLAGS & set(flags):
+        return None
+    items = split_items(text)
+    functions = [item for item in items if item.kind == 'function']
+    split = [item for item in functions if not specifiers(item) & ({'static'} | INLINE)]
+    if len(split) < 2:
+        return None
+    inline_names = {item.name for item in functions if specifiers(item) & INLINE}
+    for item in split:
+        # inline functions are only output if they are used, which would depend on the unit
+        if any([token.text in inline_names for token in item.tokens]):
+            return None
+    static_names = {item.name for item in functions if item not in split}
+
+    rest = []
+    for item in items:
+        if item in split:
+            rest.append(declaration(item, text, f' asm("{MARKER} {split.index(item)}");'))
+        else:
+            rest.append(item.text(text))
+    units = []
+    for function in split:
+        unit = []
+        for item in items:
+            if item is function:
+                unit.append(f'asm("{MARKER} begin");' + item.text(text) + f' asm("{MARKER} end");')
+            elif item.kind == 'function' and not specifiers(item) & INLINE:
+                unit.append(declaration(item, text))
+            else:
+                unit.append(item.text(text))
+        units.append(''.join(unit))
+    return Units(''.join(rest), units, static_names)
+
+
+def is_marker(line: str) -> bool:
+    return line.strip().startswith(MARKER)
+
+
+def app_lines(lines: List[str]) -> Set[int]:
+    # cc1 merges the app switches of consecutive top level asm, so all of them next to the markers are removed
+    removed = set()
+    for i, line in enumerate(lines):
+        if not is_marker(line):
+            continue
+        for step in [-1, 1]:
+            j = i + step
+            while 0 <= j < len(lines) and APP.match(lines[j]):
+                removed.add(j)
+                j += step
+    return removed
+
+
+def without_app(lines: List[str]) -> List[str]:
+    removed = app_lines(lines)
+    return [line for i, line in enumerate(lines) if i not in removed]
+
+
+def inline_asm(lines: List[str]) -> List[bool]:
+    """
+    Whether every line is output by a top level asm statement, cc1 does not close the last one at the end.
+    """
+    inside = []
+    app = False
+    for line in lines:
+        if APP_SWITCH.match(line):
+            app = 'NO_APP' not in line
+        inside.append(app)
+    return inside
+
+
+def extract(asm: str, n: int) -> str:
+    lines = without_app(insert_debug_info(asm).splitlines(True))
+    begin = next(i for i, line in enumerate(lines) if line.strip() == f'{MARKER} begin')
+    end = next(i for i, line in enumerate(lines) if line.strip() == f'{MARKER} end')
+    segment = ''.join(lines[begin + 1:end])
+    return LOCAL_LABEL.sub(lambda match: f'{match.group(1)}{int(match.group(2)) + (n + 1) * LABEL_STRIDE}', segment)
+
+
+def merge(rest: str, segments: List[str]) -> str:
+    output = []
+    # the section of the merged output and the one the rest was compiled in, they differ after a segment
+    current = None
+    section = None
+    pending = False
+    lines = insert_debug_info(rest).splitlines(True)
+    removed = app_lines(lines)
+    inside = inline_asm(lines)
+    for i, line in enumerate(lines):
+        if i in removed:
+            continue
+        if is_marker(line):
+            for segment_line in segments[int(line.split()[1])].splitlines(True):
+                if SECTION.match(segment_line):
+                    if current is not None and segment_line.strip() == current.strip():
+                        continue
+                    current = segment_line
+                output.append(segment_line)
+            pending = True
+            continue
+        if SECTION.match(line):
+            section = line
+            pending = False
+            if current is not None and line.strip() == current.strip():
+                continue
+            current = line
+        elif pending and not inside[i]:
+            # continue the rest in the section it was in, top level asm stays in the section of the function before
+            # it like in the whole translation unit
+            if section is not None and current is not None and section.strip() != current.strip():
+                output.append(section)
+                current = section
+            pending = False
+        output.append(line)
+    # every unit names the source file in front of its first line number
+    seen_file = False
+    merged = []
+    for line in ''.join(output).splitlines(True):
+        if line.startswith('.file '):
+            if seen_file:
+                continue
+            seen_file = True
+        merged.append(line)
+    return ''.join(merged)
+
+
+def run_cc1(cc1: str, flags: List[str], text: str, output: str) -> Tuple[int, str]:
+    process = subprocess.run([cc1, '-o', output] + flags, input=text.encode(errors='surrogateescape'),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return process.returncode, process.stderr.decode(errors='replace')
+
+
+def compile_split(cc1: str, flags: List[str], text: bytes, output: str, jobs: Optional[int] = None) -> bool:
+    """
+    Compiles the functions of a translation unit concurrently and writes the merged assembly, with line number
+    information already inserted. Returns False if the unit cannot be split, nothing is written then.
+    """
+    units = split_units(text.decode(errors='surrogateescape'), flags)
+    if units is None:
+        return False
+    texts = [units.rest] + units.functions
+    outputs = [f'{output}.unit{n}' for n in range(len(texts))]
+    try:
+        with ThreadPoolExecutor(max_workers=jobs or min(DEFAULT_JOBS, os.cpu_count() or 1)) as executor:
+            results = list(executor.map(lambda n: run_cc1(cc1, flags, texts[n], outputs[n]), range(len(texts))))
+        if any([status != 0 or not os.path.exists(path) for (status, _), path in zip(results, outputs)]):
+            # compiling the whole file again reports the errors the usual way
+            return False
+        asm = []
+        for path in outputs:
+            with open(path, 'r', errors='surrogateescape') as f:
+                asm.append(f.read())
+        try:
+            merged = merge(asm[0], [extract(unit, n) for n, unit in enumerate(asm[1:])])
+        except (StopIteration, IndexError, ValueError):
+            return False
+    finally:
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # declarations and data are in every unit, so are their warnings
+    reported = set()
+    for _, errors in results:
+        for line in errors.splitlines(True):
+            if line in reported or ('never defined' in line and any([f'`{name}\'' in line
+                                                                      for name in units.static_names])):
+                continue
+            reported.add(line)
+            sys.stderr.write(line)
+    with open(output, 'w', errors='surrogateescape') as f:
+        f.write(merged)
+    return True
+
+
+def raw_assembly(text: str) -> str:
+    """
+    Assembly without the switches in and out of inline assembly and redundant section switches, with the local labels
+    numbered in order, the differences the split leaves in the assembly of cc1.
+    """
+    numbers = {}
+
+    def renumber(match: re.Match) -> str:
+        return f'{match.group(1)}{numbers.setdefault(match.group(0), len(numbers))}'
+
+    lines = []
+    current = None
+    for line in text.splitlines(True):
+        if APP.match(line):
+            continue
+        if SECTION.match(line):
+            if line.strip() == current:
+                continue
+            current = line.strip()
+        lines.append(LOCAL_LABEL.sub(renumber, line))
+    return ''.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compile every C source of a directory as a whole and split into '
+                                                 'functions and compare the processed assembly')
+    parser.add_argument('directory', help='C source directory')
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('--raw', action='store_true',
+                        help='compare the assembly of cc1 instead of the processed assembly, only the local label '
+                             'numbers, inline assembly switches and redundant section switches may differ',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of sources compiled at the same time',
+                        required=False)
+    args, options = parser.parse_known_args(argv)
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+    if args.raw:
+        check_flag_sources(args.directory, options + ['--no-parse'], '--split', args.jobs, raw_assembly)
+    else:
+        check_flag_sources(args.directory, options, '--split', args.jobs)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
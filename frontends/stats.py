@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import argparse
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+
+class CounterStore:
+    """
+    Counters shared by all pycc processes, kept in a JSON file that is only changed under an exclusive lock.
+    """
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def increment(self, name: str, amount: int = 1):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            counters = json.loads(f.read() or '{}')
+            counters[name] = counters.get(name, 0) + amount
+            f.seek(0)
+            f.truncate()
+            json.dump(counters, f)
+
+    def read(self) -> Dict[str, int]:
+        try:
+            with open(self.path, 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return json.loads(f.read() or '{}')
+        except FileNotFoundError:
+            return {}
+
+    def reset(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.truncate(0)
+
+
+MAGIC = b'PYCCHST1'
+HEADER = struct.Struct('<8sd')
+STAGES = ['total', 'preprocess', 'cc1', 'debug_info', 'process_asm']
+EVENTS = ['requests', 'cache_hit', 'cache_miss', 'index_hit', 'fallback']
+# log-linear buckets over microseconds, 16 per power of two
+SUB_BUCKETS = 16
+BUCKETS = 40 * SUB_BUCKETS
+# every stage has its buckets followed by the maximum in nanoseconds
+STAGE_SIZE = BUCKETS + 1
+
+
+def bucket(microseconds: int) -> int:
+    if microseconds < SUB_BUCKETS:
+        return max(0, microseconds)
+    shift = microseconds.bit_length() - SUB_BUCKETS.bit_length()
+    return min(BUCKETS - 1, SUB_BUCKETS * (shift + 1) + (microseconds >> shift) - SUB_BUCKETS)
+
+
+def bucket_limit(index: int) -> int:
+    # the smallest value of the next bucket, in microseconds
+    index += 1
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+
+
+class Histograms:
+    """
+    Latency histograms of the pycc stages and event counters, in a form that can be added up.
+    """
+    since: float
+    cells: List[int]
+
+    def __init__(self, since: float, cells: Optional[List[int]] = None):
+        self.since = since
+        self.cells = cells or [0] * (len(STAGES) * STAGE_SIZE + len(EVENTS))
+
+    def merge(self, other: 'Histograms'):
+        self.since = min(self.since, other.since)
+        for n in range(len(STAGES)):
+            base = n * STAGE_SIZE
+            for i in range(base, base + BUCKETS):
+                self.cells[i] += other.cells[i]
+            self.cells[base + BUCKETS] = max(self.cells[base + BUCKETS], other.cells[base + BUCKETS])
+        for i in range(len(STAGES) * STAGE_SIZE, len(self.cells)):
+            self.cells[i] += other.cells[i]
+
+    def count(self, stage: str) -> int:
+        base = STAGES.index(stage) * STAGE_SIZE
+        return sum(self.cells[base:base + BUCKETS])
+
+    def percentile(self, stage: str, p: float) -> float:
+        base = STAGES.index(stage) * STAGE_SIZE
+        buckets = self.cells[base:base + BUCKETS]
+        rank = sum(buckets) * p / 100
+        seen = 0
+        for i, count in enumerate(buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_limit(i) / 1e6, self.maximum(stage))
+        return 0.0
+
+    def maximum(self, stage: str) -> float:
+        return self.cells[STAGES.index(stage) * STAGE_SIZE + BUCKETS] / 1e9
+
+    def event(self, name: str) -> int:
+        return self.cells[len(STAGES) * STAGE_SIZE + EVENTS.index(name)]
+
+
+class HistogramStore:
+    """
+    Histograms shared by all pycc processes in a memory mapped file, updated under an exclusive lock.
+    """
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def mapped(self):
+        size = HEADER.size + 8 * len(Histograms(0).cells)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != size or os.pread(fd, len(MAGIC), 0) != MAGIC:
+                # new file or a different layout
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, time.time()), 0)
+            with mmap.mmap(fd, size) as data:
+                yield data
+        finally:
+            os.close(fd)
+
+    def record(self, timings: Dict[str, float], events: Iterable[str]):
+        with self.mapped() as data:
+            cells = memoryview(data)[HEADER.size:].cast('Q')
+            try:
+                for stage, seconds in timings.items():
+                    if stage not in STAGES:
+                        continue
+                    base = STAGES.index(stage) * STAGE_SIZE
+                    cells[base + bucket(int(seconds * 1e6))] += 1
+                    cells[base + BUCKETS] = max(cells[base + BUCKETS], int(seconds * 1e9))
+                for event in events:
+                    cells[len(STAGES) * STAGE_SIZE + EVENTS.index(event)] += 1
+            finally:
+                cells.release()
+
+    def read(self) -> Histograms:
+        with self.mapped() as data:
+            _, since = HEADER.unpack_from(data)
+            cells = memoryview(data)[HEADER.size:].cast('Q')
+            try:
+                return Histograms(since, cells.tolist())
+            finally:
+                cells.release()
+
+    def reset(self):
+        with self.mapped() as data:
+            data[:] = bytes(len(data))
+            HEADER.pack_into(data, 0, MAGIC, time.time())
+
+
+class MemoryStage:
+    name: str
+    start: int
+    peak: int
+    snapshot: tracemalloc.Snapshot
+
+    def __init__(self, name: str, start: int, snapshot: tracemalloc.Snapshot):
+        self.name = name
+        self.start = start
+        self.peak = start
+        self.snapshot = snapshot
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    # the snapshots and reports of the profiler are traced as well
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                      tracemalloc.Filter(False, __file__)])
+
+
+class StageTimer:
+    """
+    Measures the stages of a request. With memory profiling, tracemalloc snapshots are taken around every stage.
+    """
+    timings: Dict[str, float]
+    events: List[str]
+    memory: Optional[List[dict]]
+    top: int
+    open_stages: List[MemoryStage]
+    # traced memory of the snapshots and reports of the profiler itself, not charged to any stage
+    held: int
+
+    def __init__(self):
+        self.timings = {}
+        self.events = []
+        self.memory = None
+        self.open_stages = []
+        self.held = 0
+
+    def profile_memory(self, top: int = 10):
+        tracemalloc.start()
+        self.memory = []
+        self.top = top
+
+    def traced(self) -> int:
+        return tracemalloc.get_traced_memory()[0] - self.held
+
+    def update_peaks(self):
+        peak = tracemalloc.get_traced_memory()[1] - self.held
+        for stage in self.open_stages:
+            stage.peak = max(stage.peak, peak)
+
+    def profiler_done(self, before: int):
+        # what the profiler allocated or freed since before, its temporary peak is dropped
+        self.held += tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.memory is not None:
+            self.update_peaks()
+            before = tracemalloc.get_traced_memory()[0]
+            self.open_stages.append(MemoryStage(name, self.traced(), take_snapshot()))
+            self.profiler_done(before)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+            if self.memory is not None:
+                self.end_memory_stage()
+
+    def end_memory_stage(self):
+        current = self.traced()
+        self.update_peaks()
+        before = tracemalloc.get_traced_memory()[0]
+        stage = self.open_stages.pop()
+        statistics = take_snapshot().compare_to(stage.snapshot, 'lineno')
+        sites = sorted(statistics, key=lambda statistic: statistic.size_diff, reverse=True)[:self.top]
+        self.memory.append({
+            'stage': stage.name,
+            'peak_bytes': stage.peak - stage.start,
+            'retained_bytes': current - stage.start,
+            'top': [{'site': f'{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}',
+                     'bytes': statistic.size_diff, 'blocks': statistic.count_diff} for statistic in sites],
+        })
+        # the snapshot of the stage is freed, the report is kept
+        del stage, statistics, sites
+        self.profiler_done(before)
+
+    def event(self, name: str):
+        self.events.append(name)
+
+
+def print_histograms(histograms: Histograms):
+    print(f'since {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(histograms.since))}')
+    print(f'{"stage":<14}{"count":>8}{"p50":>10}{"p90":>10}{"p99":>10}{"max":>10}')
+    for stage in STAGES:
+        count = histograms.count(stage)
+        if not count:
+            continue
+        print(f'{stage:<14}{count:>8}' + ''.join([f'{histograms.percentile(stage, p) * 1000:>8.1f}ms'
+                                                  for p in [50, 90, 99]]) +
+              f'{histograms.maximum(stage) * 1000:>8.1f}ms')
+    hits = histograms.event('cache_hit')
+    lookups = hits + histograms.event('cache_miss')
+    print(f'requests {histograms.event("requests")}, cache hit rate {hits / lookups * 100 if lookups else 0:.1f}% '
+          f'({hits}/{lookups}), index hits {histograms.event("index_hit")}, '
+          f'fallbacks to unprocessed assembly {histograms.event("fallback")}')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Show the counters and latency histograms of pycc')
+    parser.add_argument('files', nargs='+', help='counter files (.json) or histogram files, histograms are merged')
+    parser.add_argument('--reset', action='store_true', help='reset the files after showing them', required=False)
+    args = parser.parse_args(argv)
+
+    merged = None
+    for file in args.files:
+        if file.endswith('.json'):
+            store = CounterStore(file)
+            for name, value in sorted(store.read().items()):
+                print(f'{name:<24}{value:>10}')
+        else:
+            store = HistogramStore(file)
+            histograms = store.read()
+            if merged is None:
+                merged = histograms
+            else:
+                merged.merge(histograms)
+        if args.reset:
+            store.reset()
+    if merged is not None:
+        print_histograms(merged)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import argparse
+import re
+import sys
+from typing import Dict, List, Optional, Set, Tuple
+
+from cunits import Item, Token, split_items
+from matchcheck import check_flag_sources
+from prewarm import compiler_options
+
+LINE_MARKER = re.compile(r'#\s*(?:line\s+)?\d+\s+"((?:\\.|[^"\\])*)"')
+TAGS = {'struct', 'union', 'enum'}
+DECLARATOR_END = {';', ',', '[', '(', ')', '=', ':'}
+NOT_NAMES = {'__attribute__', '__asm__', 'asm', '__extension__'}
+
+
+def without_bodies(tokens: List[Token]) -> Tuple[List[Token], Set[str]]:
+    """
+    Removes the braces of struct, union and enum definitions. Returns the remaining tokens and the names the bodies
+    define at file scope, the tags and the enum constants.
+    """
+    remaining = []
+    names = set()
+    depth = 0
+    enum = False
+    for i, token in enumerate(tokens):
+        if token.text == '{':
+            if depth == 0:
+                tag = [t for t in tokens[max(0, i - 2):i] if t.kind == 'ident']
+                if tag and tag[-1].text not in TAGS:
+                    names.add(tag[-1].text)
+                enum = any([t.text == 'enum' for t in tokens[max(0, i - 2):i]])
+            depth += 1
+            continue
+        if token.text == '}':
+            depth -= 1
+            continue
+        if depth == 0:
+            remaining.append(token)
+        elif enum and depth == 1 and token.kind == 'ident' and tokens[i - 1].text in '{,' and \
+                tokens[i + 1].text in {'=', ',', '}'}:
+            names.add(token.text)
+    return remaining, names
+
+
+def declared_names(tokens: List[Token]) -> Tuple[Set[str], Set[str], Set[str]]:
+    """
+    The names declared by the declarators of a declaration, split into functions and everything else, and the tags
+    the declaration mentions at file scope.
+    """
+    functions = set()
+    others = set()
+    tags = set()
+    depth = 0
+    for i, token in enumerate(tokens):
+        if token.text in '([':
+            depth += 1
+        elif token.text in ')]':
+            depth -= 1
+        elif token.kind != 'ident' or token.text in NOT_NAMES:
+            continue
+        elif i > 0 and tokens[i - 1].text in TAGS:
+            if depth == 0:
+                tags.add(token.text)
+        elif i + 1 < len(tokens) and tokens[i + 1].text in DECLARATOR_END:
+            # pointers to functions are declared as (*name)
+            pointer = depth == 1 and i >= 2 and tokens[i - 1].text == '*' and tokens[i - 2].text == '(' and \
+                tokens[i + 1].text == ')'
+            if depth == 0 and tokens[i + 1].text == '(':
+                functions.add(token.text)
+            elif depth == 0 or pointer:
+                others.add(token.text)
+    return functions, others, tags
+
+
+def removable(item: Item) -> Optional[Set[str]]:
+    """
+    Returns the names defined by a declaration that generates no code or data, None for everything else.
+    """
+    tokens = item.tokens
+    if item.kind != 'declaration' or not tokens or tokens[-1].text != ';' or tokens[0].text in {'asm', '__asm__'}:
+        return None
+    remaining, names = without_bodies(tokens)
+    functions, others, tags = declared_names(remaining)
+    # a tag mentioned for the first time is declared here, so these declarations define their tags as well
+    first = remaining[0].text
+    if first == 'typedef':
+        return names | others | tags
+    # anything else with an initializer defines data
+    if any([token.text == '=' for token in remaining]):
+        return None
+    if first == 'extern' or not others:
+        return names | functions | others | tags
+    return None
+
+
+def source_file(marker: str) -> Optional[str]:
+    match = LINE_MARKER.match(marker)
+    return match.group(1) if match else None
+
+
+def shake(text: str) -> Tuple[str, int]:
+    """
+    Blanks the declarations of included files that are not referenced, transitively, by the main file or by anything
+    that generates code. Line breaks are kept, so line numbers and debug information do not change.
+    Returns the text and the number of removed declarations.
+    """
+    items = split_items(text)
+    main_file = None
+    current = None
+    candidates = []
+    defined_by: Dict[str, List[int]] = {}
+    needed = set()
+    for item in items:
+        if item.kind == 'directive':
+            current = source_file(item.tokens[0].text) or current
+            main_file = main_file or current
+            continue
+        names = removable(item) if current != main_file else None
+        if names is None:
+            needed.update([token.text for token in item.tokens if token.kind == 'ident'])
+            continue
+        for name in names:
+            defined_by.setdefault(name, []).append(len(candidates))
+        candidates.append(item)
+
+    kept = [False] * len(candidates)
+    pending = list(needed)
+    while pending:
+        for n in defined_by.get(pending.pop(), []):
+            if kept[n]:
+                continue
+            kept[n] = True
+            for token in candidates[n].tokens:
+                if token.kind == 'ident' and token.text not in needed:
+                    needed.add(token.text)
+                    pending.append(token.text)
+
+    removed = {id(item) for item, keep in zip(candidates, kept) if not keep}
+    parts = []
+    for item in items:
+        part = item.text(text)
+        parts.append('\n' * part.count('\n') if id(item) in removed else part)
+    return ''.join(parts), len(removed)
+
+
+def shake_file(path: str) -> int:
+    with open(path, 'r', errors='surrogateescape') as f:
+        text, removed = shake(f.read())
+    with open(path, 'w', errors='surrogateescape') as f:
+        f.write(text)
+    return removed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Remove unreferenced declarations from preprocessed C. check compiles '
+                                                 'every source with and without it and compares the processed '
+                                                 'assembly, --tree-shake should only be used once it matches for '
+                                                 'every source of the repository.')
+    parser.add_argument('command', choices=['shake', 'check'])
+    parser.add_argument('path', help='preprocessed file for shake, C source directory for check')
+    parser.add_argument('--properties', help='compiler explorer properties file to read the pycc options from',
+                        required=False)
+    parser.add_argument('--compiler', default='tmc_agbcc', help='compiler id in the properties file',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, help='number of concurrent compilations', required=False)
+    args, options = parser.parse_known_args(argv)
+
+    if args.command == 'shake':
+        with open(args.path, 'r', errors='surrogateescape') as f:
+            text, removed = shake(f.read())
+        sys.stdout.write(text)
+        print(f'removed {removed} declarations', file=sys.stderr)
+        return
+
+    if args.properties:
+        options = compiler_options(args.properties, args.compiler) + options
+    check_flag_sources(args.path, options, '--tree-shake', args.jobs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Set
+
+from asm_index import AsmIndex, build_index
+from prewarm import find_sources
+
+INCLUDE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*"([^"]+)"', re.MULTILINE)
+PREPROC = os.path.join('tools', 'preproc')
+# every compile key contains the preprocessed text, the stamps of these files and the cc1 flags
+GLOBAL_DEPENDENCIES = ['charmap.txt']
+
+
+def git(repo: str, *args: str) -> str:
+    return subprocess.run(['git', '-C', repo] + list(args), stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+
+
+def changed_files(repo: str, old: str, new: str) -> List[str]:
+    if old == new:
+        return []
+    return git(repo, 'diff', '--name-only', old, new).splitlines()
+
+
+def read_state(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_state(path: str, revision: str):
+    with open(path + '.tmp', 'w') as f:
+        f.write(revision + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def direct_includes(path: str, include_dirs: List[str], known: Dict[str, List[str]]) -> List[str]:
+    if path not in known:
+        try:
+            with open(path, 'r', errors='surrogateescape') as f:
+                names = INCLUDE.findall(f.read())
+        except FileNotFoundError:
+            names = []
+        resolved = []
+        for name in names:
+            for directory in [os.path.dirname(path)] + include_dirs:
+                candidate = os.path.normpath(os.path.join(directory, name))
+                if os.path.exists(candidate):
+                    resolved.append(candidate)
+                    break
+        known[path] = resolved
+    return known[path]
+
+
+def dependencies(source: str, include_dirs: List[str], known: Dict[str, List[str]]) -> Set[str]:
+    seen = {source}
+    pending = [source]
+    while pending:
+        for path in direct_includes(pending.pop(), include_dirs, known):
+            if path not in seen:
+                seen.add(path)
+                pending.append(path)
+    return seen
+
+
+def affected_sources(repo: str, changed: Set[str]) -> List[str]:
+    include_dirs = [os.path.join(repo, 'include')]
+    known = {}
+    changed_paths = {os.path.normpath(os.path.join(repo, path)) for path in changed}
+    return [source for source in find_sources(os.path.join(repo, 'src'))
+            if dependencies(source, include_dirs, known) & changed_paths]
+
+
+def index_is_current(index: str) -> bool:
+    # an index of another frontend version cannot be reused
+    return AsmIndex.open(index) is not None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Update the tmc repository and rebuild only what the update changed. '
+                                                 'The C sources whose compile cache entries changed are printed.')
+    parser.add_argument('repo', help='tmc repository')
+    parser.add_argument('--asm-index', help='assembly index to update', required=False)
+    parser.add_argument('--state', help='file with the revision of the last update, .git/cexplore-revision of the '
+                                        'repository by default', required=False)
+    parser.add_argument('--no-pull', action='store_true', help='only process the changes since the last update',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes for the index', required=False)
+    args = parser.parse_args(argv)
+    state = args.state or os.path.join(args.repo, '.git', 'cexplore-revision')
+
+    start = time.monotonic()
+    old = read_state(state) or git(args.repo, 'rev-parse', 'HEAD')
+    if not args.no_pull:
+        subprocess.run(['git', '-C', args.repo, 'pull'], stdout=sys.stderr, check=True)
+    new = git(args.repo, 'rev-parse', 'HEAD')
+    changed = set(changed_files(args.repo, old, new))
+    print(f'{old[:10]}..{new[:10]}: {len(changed)} files changed', file=sys.stderr)
+
+    # the compile cache keys contain the modification time of preproc, rebuilding it invalidates every entry
+    rebuild_preproc = any([path.startswith(PREPROC + '/') for path in changed]) or \
+        not os.path.exists(os.path.join(args.repo, PREPROC, 'preproc'))
+    if rebuild_preproc:
+        subprocess.run(['make', '-C', os.path.join(args.repo, PREPROC)], stdout=sys.stderr, check=True)
+    print(f'preproc {"rebuilt" if rebuild_preproc else "unchanged"}', file=sys.stderr)
+
+    if args.asm_index:
+        asm_changed = [path for path in changed if path.startswith('asm/') and path.endswith(('.s', '.inc'))]
+        if not index_is_current(args.asm_index):
+            count, failed = build_index(os.path.join(args.repo, 'asm'), args.asm_index, args.jobs)
+            print(f'index rebuilt, {count} functions, {failed} failed', file=sys.stderr)
+        elif asm_changed:
+            count, failed = build_index(os.path.join(args.repo, 'asm'), args.asm_index, args.jobs, args.asm_index)
+            print(f'index updated for {len(asm_changed)} files, {count} functions, {failed} failed', file=sys.stderr)
+        else:
+            print('index unchanged', file=sys.stderr)
+
+    if rebuild_preproc or changed & set(GLOBAL_DEPENDENCIES):
+        sources = find_sources(os.path.join(args.repo, 'src'))
+    else:
+        sources = affected_sources(args.repo, changed)
+    for source in sources:
+        print(source)
+    write_state(state, new)
+    print(f'{len(sources)} sources affected, updated in {time.monotonic() - start:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,2 +1,4 @@
 #!/bin/sh
-cd /repos/tmc && git pull && make setup
\ No newline at end of file
+python3 /frontends/update.py /repos/tmc --asm-index /repos/tmc-asm.idx > /tmp/prewarm.sources || exit 1
+# warm the compile cache for the changed sources in the background
+nohup python3 /frontends/prewarm.py --properties /ce/etc/config/c.local.properties --sources /tmp/prewarm.sources /repos/tmc/src > /tmp/prewarm.log 2>&1 &